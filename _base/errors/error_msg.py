@@ -75,6 +75,7 @@ FLOAT_RANGE_FAIL = 'The float (%s) value must be in range %s.'
 GROUPER_LDAP = 'Error on LDAP validation, please try again later: %s'
 INT_FAIL = 'The input is not an integer.'
 INT_RANGE_FAIL = 'The integer (%s) must be in range %s.'
+INVALID_CURSOR = 'Invalid cursor for this query: %r.'
 INVALID_DATE = '%s is not a valid date.'
 INVALID_EMAIL = '%s is not a valid email address.'
 INVALID_FK = 'Value "%s" for field %s has no entry in %s.%s.'
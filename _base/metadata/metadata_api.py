@@ -1,19 +1,26 @@
 """Metadata API for Double Helix app."""
 
-import logging
-import threading
+import collections
+import copy
+import functools
+import operator
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from _base.utils import memoize
 
+from _base.metadata import metadata_cache
 from _base.metadata import metadata_conditional
 from _base.metadata import metadata_conversions
 from _base.metadata import metadata_messages
 from _base.metadata import metadata_models
 from _base.metadata import metadata_utils
+from _base.metadata import metadata_validator
 from _base.utils import constants
 from _base.utils import model_utils
+from _base.utils import signals
+from _base.utils import yaml_utils
 
 # Kinds that represent virtual base classes and should not be instantiated.
 BASE_CLASS_KINDS = frozenset([
@@ -23,6 +30,112 @@ BASE_CLASS_KINDS = frozenset([
     'MetadataMetaModel'
 ])
 
+# Metadata cache namespaces for fully merged metadata instances and the kind
+# catalog.
+_METADATA_CACHE = 'metadata'
+_CATALOG_CACHE = 'catalog'
+
+# Maximum number of attempts to update the kind catalog in memcache.
+_CATALOG_CAS_RETRIES = 5
+
+# Boolean field settings with precomputed field names, see GetFieldNames.
+INDEXED_FIELD_SETTINGS = frozenset([
+    'index_for_query',
+    'index_for_search',
+    'required',
+    'ui_hidden',
+    'ui_readonly',
+    'unique',
+])
+
+# Field names of a kind indexed by setting, see GetFieldNameIndexCached.
+FieldNameIndex = collections.namedtuple(
+    'FieldNameIndex', ['names', 'tuples', 'sets'])
+
+# Summary of the metadata of a kind, see GetKindCatalogAsync.
+KindSummary = collections.namedtuple(
+    'KindSummary', ['kind', 'field_count', 'is_mv', 'export_bigquery'])
+
+# Mapping of model classes to their merged model-defined metadata options.
+_STATIC_OPTIONS = {}
+
+
+def _CombineOptions(options, update):
+  """Combines two dicts of metadata options into one.
+
+  Applying the result with metadata_utils.UpdateMetadata has the same effect
+  as applying options and then update.
+
+  Args:
+    options: dict, the metadata options applied first.
+    update: dict, the metadata options applied second.
+
+  Returns:
+    dict, the combined options or None if they can't be combined (e.g. when
+    update merges into a field that options resets).
+  """
+  combined = dict(options)
+  for key, value in update.iteritems():
+    if isinstance(value, dict) and key in options:
+      current = options[key]
+      if not isinstance(current, dict):
+        return None
+      items = dict(current)
+      for name, item_options in value.iteritems():
+        if isinstance(item_options, dict) and name in current:
+          if not isinstance(current[name], dict):
+            return None
+          item_options = _CombineOptions(current[name], item_options)
+          if item_options is None:
+            return None
+        items[name] = item_options
+      value = items
+    combined[key] = value
+  return combined
+
+
+def _GetStaticOptions(cls):
+  """Returns the model-defined metadata options of a model class.
+
+  Meta class defaults (in reverse Method Resolution Order) and model property
+  defaults only depend on the class, so they are merged once per class and
+  rebuilt only if the class properties change.
+
+  Args:
+    cls: MetadataModel subclass.
+
+  Returns:
+    list<dict>, metadata options to be applied in order.
+  """
+  properties = cls._properties  # pylint: disable=protected-access
+  cached = _STATIC_OPTIONS.get(cls)
+  if cached and cached[0] is properties and cached[1] == len(properties):
+    return cached[2]
+  layers = []
+  # Meta class metadata is applied in reverse Method Resolution Order.
+  for base_cls in reversed(cls.mro()):
+    if isinstance(base_cls, metadata_models.MetadataMetaModel):
+      base_kind = base_cls._get_kind()  # pylint: disable=protected-access
+      defaults = metadata_models.METADATA_DEFAULTS.get(base_kind)
+      if defaults:
+        layers.append(defaults)
+  # Model properties override everything. It doesn't make sense for a model
+  # to have inconsistent properties Meta vs. the class properties, so this
+  # should not override anything in Meta. metadata.consistency_test checks
+  # for this.
+  fields = metadata_utils.GetModelDefaults(properties)
+  if fields:
+    layers.append({'fields': fields})
+  merged = []
+  for layer in layers:
+    combined = _CombineOptions(merged[-1], layer) if merged else None
+    if combined is None:
+      merged.append(layer)
+    else:
+      merged[-1] = combined
+  _STATIC_OPTIONS[cls] = (properties, len(properties), merged)
+  return merged
+
 
 def ApplyModelDefinedMetadata(kind, metadata):
   """Apply model-defined metadata to a metadata instance.
@@ -55,35 +168,156 @@ def ApplyModelDefinedMetadata(kind, metadata):
     if cls is None:
       # Always include base metadata even if a class isn't defined.
       cls = metadata_models.MetadataModel
-    # Meta class metadata is applied in reverse Method Resolution Order.
-    for base_cls in reversed(cls.mro()):
-      if isinstance(base_cls, metadata_models.MetadataMetaModel):
-        base_kind = base_cls._get_kind()  # pylint: disable=protected-access
-        defaults = metadata_models.METADATA_DEFAULTS.get(base_kind)
-        if defaults:
-          metadata_utils.UpdateMetadata(metadata, defaults)
-    # Model properties override everything. It doesn't make sense for a model
-    # to have inconsistent properties Meta vs. the class properties, so this
-    # should not override anything in Meta. metadata.consistency_test checks
-    # for this.
-    properties = cls._properties  # pylint: disable=protected-access
-    fields = metadata_utils.GetModelDefaults(properties)
-    if fields:
-      metadata_utils.UpdateMetadata(metadata, {'fields': fields})
+    # Meta class and model property defaults are precomputed per class.
+    for options in _GetStaticOptions(cls):
+      metadata_utils.UpdateMetadata(metadata, options)
     # Is_managed cannot be modified.
     is_managed = kind in model_utils.GetManagedModels()
     metadata_utils.UpdateMetadata(metadata, {'is_managed': is_managed})
   return metadata
 
 
+def _SummarizeMetadata(metadata):
+  """Returns the catalog values for merged metadata as a picklable tuple."""
+  return (len(metadata.fields), metadata.is_mv, metadata.export_bigquery)
+
+
+def _SummarizeStoredMetadata(kind, metadata):
+  """Returns the catalog values for metadata as stored in the datastore."""
+  metadata = ApplyModelDefinedMetadata(
+      kind, metadata_utils.CloneMetadata(metadata))
+  return _SummarizeMetadata(metadata)
+
+
+@ndb.tasklet
+def _GetStoredCatalogAsync():
+  """Returns summaries of all stored metadata, rebuilding them if necessary.
+
+  Yields:
+    dict, kinds with metadata in the datastore, with summary tuples.
+  """
+  key = constants.METADATA_CATALOG_MEMCACHE_KEY
+  stored = yield ndb.get_context().memcache_get(key)
+  if stored is None:
+    query = metadata_models.Metadata.query()
+    keys = yield query.fetch_async(keys_only=True, batch_size=1000)
+    kinds = filter(None, (k.string_id() for k in keys))
+    metadata_list = yield GetMetadataMultiAsync(kinds)
+    stored = {kind: _SummarizeMetadata(metadata)
+              for kind, metadata in zip(kinds, metadata_list) if metadata}
+    yield ndb.get_context().memcache_add(
+        key, stored, time=constants.METADATA_CATALOG_TIMEOUT)
+  raise ndb.Return(stored)
+
+
+def UpdateKindCatalog(kind, metadata):
+  """Updates the summary of a kind in the stored kind catalog.
+
+  Called when a Metadata entity is put or deleted. If the update fails, the
+  catalog is dropped and rebuilt by the next reader.
+
+  Args:
+    kind: str, the model kind.
+    metadata: metadata_messages.Metadata, the stored metadata, or None if it
+        was deleted.
+  """
+  key = constants.METADATA_CATALOG_MEMCACHE_KEY
+  summary = _SummarizeStoredMetadata(kind, metadata) if metadata else None
+  client = memcache.Client()
+  for _ in xrange(_CATALOG_CAS_RETRIES):
+    stored = client.gets(key)
+    if stored is None:
+      return  # Nothing to update, it is rebuilt when read.
+    stored = dict(stored)
+    if summary is None:
+      stored.pop(kind, None)
+    else:
+      stored[kind] = summary
+    if client.cas(key, stored, time=constants.METADATA_CATALOG_TIMEOUT):
+      return
+  client.delete(key)
+
+
+@ndb.tasklet
+def GetKindCatalogAsync():
+  """Returns summaries of all kinds that have metadata.
+
+  The catalog is cached per metadata version, and the summaries of stored
+  metadata are shared through memcache and updated incrementally when Metadata
+  entities are put or deleted, so listing kinds doesn't require a query or the
+  full metadata of each kind.
+
+  Yields:
+    dict, kinds with KindSummary tuples. The dict is shared and must not be
+    modified.
+  """
+  catalog = metadata_cache.Get(_CATALOG_CACHE, None)
+  if catalog is metadata_cache.MISSING:
+    stored = yield _GetStoredCatalogAsync()
+    catalog = {}
+    for kind in set(metadata_models.METADATA_KIND_MAP) - BASE_CLASS_KINDS:
+      if kind and kind not in stored:
+        # Kinds defined in code only.
+        metadata = ApplyModelDefinedMetadata(kind, None)
+        catalog[kind] = KindSummary(kind, *_SummarizeMetadata(metadata))
+    for kind, summary in stored.iteritems():
+      catalog[kind] = KindSummary(kind, *summary)
+    metadata_cache.Set(_CATALOG_CACHE, None, catalog)
+  raise ndb.Return(catalog)
+
+
+def GetKindCatalog():
+  return GetKindCatalogAsync().get_result()
+
+
 @ndb.tasklet
 def GetKindsAsync():
   """Returns a list of kinds that have metadata."""
-  query = metadata_models.Metadata.query()
-  keys = yield query.fetch_async(keys_only=True, batch_size=1000)
-  kinds = set(metadata_models.METADATA_KIND_MAP) - BASE_CLASS_KINDS
-  kinds.update(k.string_id() for k in keys)
-  raise ndb.Return(sorted(filter(None, kinds)))
+  catalog = yield GetKindCatalogAsync()
+  raise ndb.Return(sorted(catalog))
+
+
+@ndb.non_transactional
+@ndb.tasklet
+def GetMetadataMultiAsync(kinds):
+  """Loads metadata for many kinds with a single batch get.
+
+  Note: Defaults might not be applied if the corresponding model hasn't been
+  imported yet. This will not include any thread-local changes. Use model._meta
+  for that instead.
+
+  Args:
+    kinds: list<str>, the model kinds.
+
+  Yields:
+    list<metadata_messages.Metadata>, in the same order as kinds. Items are
+    None for kinds without metadata.
+  """
+  kinds = list(kinds)
+  keys = [ndb.Key(metadata_models.Metadata, kind) for kind in kinds if kind]
+  # Bypass the context cache, defaults are applied to the loaded instances.
+  entities = yield ndb.get_multi_async(keys, use_cache=False)
+  by_kind = {e.key.string_id(): e.metadata for e in entities if e}
+  raise ndb.Return([ApplyModelDefinedMetadata(kind, by_kind.get(kind))
+                    for kind in kinds])
+
+
+def GetMetadataMulti(kinds):
+  return GetMetadataMultiAsync(kinds).get_result()
+
+
+@ndb.tasklet
+def GetMetadataAsync(kind):
+  """Returns metadata loaded from datastore with defaults applied.
+
+  Args:
+    kind: str, the model kind.
+
+  Yields:
+    metadata_messages.Metadata instance or None if not found.
+  """
+  results = yield GetMetadataMultiAsync([kind])
+  raise ndb.Return(results[0])
 
 
 def GetMetadata(kind):
@@ -99,24 +333,229 @@ def GetMetadata(kind):
   Returns:
     metadata_messages.Metadata instance or None if not found.
   """
-  # Get metadata from the datastore in a separate thread.
-  result = []
-  target = lambda: result.append(metadata_models.Metadata.get_by_id(kind))
-  thread = threading.Thread(target=target)
-  thread.start()
-  thread.join()
-  if result:
-    entity = result[0]
-  else:
-    logging.error('Threading error retrieving metadata for %r.', kind)
-    entity = None
-  metadata = entity.metadata if entity else None
+  return GetMetadataAsync(kind).get_result()
+
+
+def LoadBundledMetadata(kind):
+  """Returns the metadata of a kind as defined by its bundled YAML file.
+
+  Args:
+    kind: str, the model kind.
+
+  Returns:
+    metadata_messages.Metadata instance with defaults applied, or None if the
+    kind has no metadata file.
+  """
+  filename = metadata_utils.KindFilenameDict().get(kind)
+  if not filename:
+    return None
+  metadata = metadata_messages.Metadata(kind=kind)
+  metadata_utils.UpdateMetadata(
+      metadata, yaml_utils.LoadFromFile(filename) or {})
   return ApplyModelDefinedMetadata(kind, metadata)
 
 
+@ndb.tasklet
+def DiffBundledMetadataAsync(kinds=None):
+  """Compares stored metadata with the bundled YAML files for many kinds.
+
+  The stored metadata is loaded with a single batch get while the YAML files
+  are parsed.
+
+  Args:
+    kinds: list<str>, the model kinds, defaults to all kinds with a bundled
+        metadata file.
+
+  Yields:
+    dict, kinds with the list of errors reported by metadata_utils.MetadataDiff
+    for kinds whose stored metadata differs from the bundled metadata.
+  """
+  if kinds is None:
+    kinds = metadata_utils.KindFilenameDict().keys()
+  kinds = sorted(kinds)
+  stored_future = GetMetadataMultiAsync(kinds)
+  bundled = [LoadBundledMetadata(kind) for kind in kinds]
+  stored = yield stored_future
+  diffs = {}
+  for kind, bundled_metadata, stored_metadata in zip(kinds, bundled, stored):
+    if bundled_metadata is None or stored_metadata is None:
+      continue
+    errors = metadata_utils.MetadataDiff(kind, stored_metadata,
+                                         bundled_metadata)
+    if errors:
+      diffs[kind] = errors
+  raise ndb.Return(diffs)
+
+
+def DiffBundledMetadata(kinds=None):
+  return DiffBundledMetadataAsync(kinds).get_result()
+
+
+def _GetCachedEntry(kind):
+  """Returns cached metadata for a kind, or MISSING if it must be reloaded."""
+  cls = metadata_models.METADATA_KIND_MAP.get(kind)
+  cached = metadata_cache.Get(_METADATA_CACHE, kind)
+  if cached is not metadata_cache.MISSING and cached[0] is cls:
+    return cached[1]
+  return metadata_cache.MISSING
+
+
+@ndb.tasklet
+def GetCachedMetadataMultiAsync(kinds):
+  """Returns process-wide cached metadata for many kinds.
+
+  Kinds missing from the cache are loaded with a single batch get. See
+  GetCachedMetadata for restrictions on the returned instances.
+
+  Args:
+    kinds: list<str>, the model kinds.
+
+  Yields:
+    list<metadata_messages.Metadata>, in the same order as kinds.
+  """
+  kinds = list(kinds)
+  results = [_GetCachedEntry(kind) for kind in kinds]
+  missing = sorted({kind for kind, metadata in zip(kinds, results)
+                    if metadata is metadata_cache.MISSING})
+  if missing:
+    classes = [metadata_models.METADATA_KIND_MAP.get(k) for k in missing]
+    loaded = yield GetMetadataMultiAsync(missing)
+    for kind, cls, metadata in zip(missing, classes, loaded):
+      metadata_cache.Set(_METADATA_CACHE, kind, (cls, metadata))
+    loaded = dict(zip(missing, loaded))
+    results = [loaded[kind] if metadata is metadata_cache.MISSING else metadata
+               for kind, metadata in zip(kinds, results)]
+  raise ndb.Return(results)
+
+
+def GetCachedMetadata(kind):
+  """Returns process-wide cached metadata with defaults applied.
+
+  The returned instance is shared by all requests on this instance and MUST NOT
+  be modified. It is reloaded when the metadata version changes or when the
+  model class registered for the kind changes. Use model._meta for thread-local
+  changes.
+
+  Args:
+    kind: str, the model kind.
+
+  Returns:
+    metadata_messages.Metadata instance or None if not found.
+  """
+  metadata = _GetCachedEntry(kind)
+  if metadata is metadata_cache.MISSING:
+    metadata = GetCachedMetadataMultiAsync([kind]).get_result()[0]
+  return metadata
+
+
+def _IsSharedMetadata(kind, metadata):
+  """Returns True if metadata is the shared instance for a kind or a view of it.
+
+  Args:
+    kind: str, the model kind.
+    metadata: metadata_messages.Metadata|metadata_utils.MetadataOverlay, the
+        metadata to check.
+
+  Returns:
+    bool, whether values derived from the shared metadata apply to metadata.
+  """
+  if isinstance(metadata, metadata_utils.MetadataOverlay):
+    metadata = metadata.shared or metadata
+  return metadata is GetCachedMetadata(kind)
+
+
+def _DerivedCache(namespace):
+  """Decorator caching values derived from the shared metadata of a kind.
+
+  The decorated function must accept (kind, metadata=None). Its results are
+  cached per kind for the current metadata version, so they are dropped when
+  metadata changes. Calls with request or entity specific metadata (anything
+  other than the shared instance or an unchanged view of it) bypass the cache.
+
+  Cached results are shared and must not be modified by callers.
+
+  Args:
+    namespace: str, the metadata cache namespace for the derived values.
+
+  Returns:
+    The decorator.
+  """
+  def Decorator(func):
+    @functools.wraps(func)
+    def Wrapper(kind, metadata=None):
+      if metadata is not None and not _IsSharedMetadata(kind, metadata):
+        return func(kind, metadata)
+      value = metadata_cache.Get(namespace, kind)
+      if value is metadata_cache.MISSING:
+        value = func(kind, GetCachedMetadata(kind))
+        metadata_cache.Set(namespace, kind, value)
+      return value
+    return Wrapper
+  return Decorator
+
+
+@signals.INSTANCE_WARMUP.connect
+def PreloadMetadata(unused_sender):
+  """Loads metadata for all kinds into the instance cache on warmup."""
+  kinds = GetKindsAsync().get_result()
+  GetCachedMetadataMultiAsync(kinds).get_result()
+
+
+def _SortFieldNames(fields):
+  """Returns the names of fields, ordered for display."""
+  fields = sorted(fields, key=operator.attrgetter('display_order', 'name'))
+  return tuple([field.name for field in fields])
+
+
+@_DerivedCache('field_names')
+def GetFieldNameIndexCached(kind, metadata=None):
+  """Returns the field names of a kind indexed by common boolean settings.
+
+  Args:
+    kind: str, the model kind.
+    metadata: metadata_messages.Metadata instance.
+
+  Returns:
+    FieldNameIndex, the display ordered field names, and for each of
+        INDEXED_FIELD_SETTINGS the display ordered names and the set of names of
+        the fields with the setting True and False.
+  """
+  metadata = metadata if metadata else GetCachedMetadata(kind)
+  fields = {f.name: f for f in metadata.fields} if metadata else {}
+  tuples = {}
+  sets = {}
+  for setting in INDEXED_FIELD_SETTINGS:
+    for value in (True, False):
+      names = _SortFieldNames(
+          f for f in fields.itervalues() if getattr(f, setting) == value)
+      tuples[setting, value] = names
+      sets[setting, value] = frozenset(names)
+  return FieldNameIndex(_SortFieldNames(fields.itervalues()), tuples, sets)
+
+
+def _GetMetadataView(obj):
+  """Returns the metadata of a model or entity, possibly a MetadataOverlay.
+
+  Unlike entity._meta, this doesn't copy the metadata of entities that have
+  their own changes.
+
+  Args:
+    obj: MetadataModel subclass or entity.
+
+  Returns:
+    metadata_messages.Metadata|metadata_utils.MetadataOverlay, or None.
+  """
+  if not isinstance(obj, type) and hasattr(obj, '_get_meta_view'):
+    return obj._get_meta_view()  # pylint: disable=protected-access
+  return getattr(obj, '_meta', None)
+
+
 def GetFieldNames(obj, **filters):
   """Returns the field names of a MetadataModel subclass or entity.
 
+  Filters on INDEXED_FIELD_SETTINGS are answered from a per-version index when
+  obj uses the shared metadata of its kind.
+
   Args:
     obj: MetadataModel subclass or entity to be queried.
     **filters: metadata setting values to filter on.
@@ -124,16 +563,26 @@ def GetFieldNames(obj, **filters):
   Returns:
     tuple, the field names that match the given filters.
   """
-  metadata = getattr(obj, '_meta', None)
+  metadata = _GetMetadataView(obj)
   if not metadata:
     return ()
+  if (all(key in INDEXED_FIELD_SETTINGS and value in (True, False)
+          for key, value in filters.iteritems()) and
+      _IsSharedMetadata(metadata.kind, metadata)):
+    index = GetFieldNameIndexCached(metadata.kind)
+    if not filters:
+      return index.names
+    if len(filters) == 1:
+      return index.tuples[filters.items()[0]]
+    names = frozenset.intersection(
+        *[index.sets[item] for item in filters.iteritems()])
+    return tuple([name for name in index.names if name in names])
   fields = {f.name: f for f in metadata.fields}
   for key, value in filters.iteritems():
     for name, field in fields.items():
       if getattr(field, key) != value:
         del fields[name]
-  sorted_fields = sorted(fields.values(), key=lambda f: f.display_order)
-  return tuple([field.name for field in sorted_fields])
+  return _SortFieldNames(fields.itervalues())
 
 
 def GetParentKind(obj):
@@ -145,7 +594,7 @@ def GetParentKind(obj):
   Returns:
     parent kind or None if the parent kind is not defined in metadata.
   """
-  metadata = getattr(obj, '_meta', None)
+  metadata = _GetMetadataView(obj)
   if metadata and metadata.parent:
     return metadata.parent.kind
   else:
@@ -161,7 +610,7 @@ def GetParentKeyField(obj):
   Returns:
     parent key_field or None if the parent is not defined in metadata.
   """
-  metadata = getattr(obj, '_meta', None)
+  metadata = _GetMetadataView(obj)
   if metadata and metadata.parent:
     if metadata.parent.key_field:
       return metadata.parent.key_field
@@ -171,7 +620,7 @@ def GetParentKeyField(obj):
     return None
 
 
-#@memoize.Memoize(warn_on_error=False, timeout=600, cache_positions=[0])
+@_DerivedCache('default_values')
 def GetMetadataDefaultValuesCached(kind, metadata=None):
   """Returns the field default values for a metadata kind.
 
@@ -181,8 +630,9 @@ def GetMetadataDefaultValuesCached(kind, metadata=None):
 
   Returns:
     dict, containing metadata-defined field names with coerced default values.
+        The dict is shared and must not be modified.
   """
-  metadata = metadata if metadata else GetMetadata(kind)
+  metadata = metadata if metadata else GetCachedMetadata(kind)
   if metadata and metadata.fields:
     return metadata_conversions.GetMetadataDefaultValues(metadata.fields)
   else:
@@ -202,7 +652,7 @@ def ApplyMetadataDefaultValues(metadata, model_dict):
   if coerced_defaults:
     for field_name in coerced_defaults:
       if model_dict.get(field_name) is None:
-        model_dict[field_name] = coerced_defaults[field_name]
+        model_dict[field_name] = copy.deepcopy(coerced_defaults[field_name])
 
 
 def ApplyMetadataDefaultValuesToEntity(metadata, entity):
@@ -218,10 +668,10 @@ def ApplyMetadataDefaultValuesToEntity(metadata, entity):
   if coerced_defaults:
     for field_name in coerced_defaults:
       if getattr(entity, field_name, None) is None:
-        setattr(entity, field_name, coerced_defaults[field_name])
+        setattr(entity, field_name, copy.deepcopy(coerced_defaults[field_name]))
 
 
-#@memoize.Memoize(warn_on_error=False, timeout=600, cache_positions=[0])
+@_DerivedCache('indexed_fields')
 def GetIndexedFieldsCached(kind, metadata=None):
   """Returns the fields that are indexed for a metadata kind.
 
@@ -230,16 +680,17 @@ def GetIndexedFieldsCached(kind, metadata=None):
     metadata: metadata_messages.Metadata instance.
 
   Returns:
-    set, containing metadata-defined indexed field names.
+    frozenset, containing metadata-defined indexed field names.
   """
-  metadata = metadata if metadata else GetMetadata(kind)
+  metadata = metadata if metadata else GetCachedMetadata(kind)
   if metadata and metadata.fields:
-    return {field.name for field in metadata.fields if field.index_for_query}
-  return set()
+    return frozenset(
+        field.name for field in metadata.fields if field.index_for_query)
+  return frozenset()
 
 
-#@memoize.Memoize(timeout=600, memoize_parallel_calls=True)
-def GetAlternateKeyConfigs(metadata_kind):
+@_DerivedCache('alt_keys')
+def GetAlternateKeyConfigs(metadata_kind, metadata=None):
   """Retrieve the alternate key configurations from a given metadata model.
 
   The returned dictionary contains the alternate key names and will return the
@@ -252,11 +703,13 @@ def GetAlternateKeyConfigs(metadata_kind):
 
   Args:
     metadata_kind: str, the kind of metadata to get.
+    metadata: metadata_messages.Metadata instance.
 
   Returns:
-    dict, A dictionary with the alternate key configurations.
+    dict, A dictionary with the alternate key configurations. The dict is
+        shared and must not be modified.
   """
-  metadata = GetMetadata(metadata_kind)
+  metadata = metadata if metadata else GetCachedMetadata(metadata_kind)
   if not metadata:
     return {}
   alt_keys = {}
@@ -266,7 +719,7 @@ def GetAlternateKeyConfigs(metadata_kind):
   return alt_keys
 
 
-#@memoize.Memoize(warn_on_error=False, timeout=600, cache_positions=[0])
+@_DerivedCache('foreign_keys')
 def GetMetadataForeignKeyFieldsCached(kind, metadata=None):
   """Returns the fields identified as foreign key fields.
 
@@ -279,9 +732,10 @@ def GetMetadataForeignKeyFieldsCached(kind, metadata=None):
 
   Returns:
     dict<str, tuple>, metadata-defined field name with tuple containing foreign
-        key kind and foreign key field name.
+        key kind and foreign key field name. The dict is shared and must not be
+        modified.
   """
-  metadata = metadata if metadata else GetMetadata(kind)
+  metadata = metadata if metadata else GetCachedMetadata(kind)
   foreign_keys = {}
   if metadata and metadata.fields:
     fk_end = constants.FK_SEP + constants.KEY_NAME
@@ -292,6 +746,44 @@ def GetMetadataForeignKeyFieldsCached(kind, metadata=None):
   return foreign_keys
 
 
+@_DerivedCache('validators')
+def GetRowValidatorCached(kind, metadata=None):
+  """Returns the compiled row validator for a metadata kind.
+
+  Args:
+    kind: str, the model kind.
+    metadata: metadata_messages.Metadata instance.
+
+  Returns:
+    metadata_validator.RowValidator instance, or None if there is no metadata.
+  """
+  metadata = metadata if metadata else GetCachedMetadata(kind)
+  if metadata:
+    return metadata_validator.RowValidator(metadata)
+  return None
+
+
+@_DerivedCache('conditionals')
+def GetAssembledConditionalsCached(kind, metadata=None):
+  """Returns the assembled conditional rules for a metadata kind.
+
+  Rules compile their operator and rule value on first evaluation, so the
+  cached instances are only compiled once per metadata version.
+
+  Args:
+    kind: str, the model kind.
+    metadata: metadata_messages.Metadata instance.
+
+  Returns:
+    dict, field names with lists of metadata_conditional.AssembledConditional.
+        The dict is shared and must not be modified.
+  """
+  metadata = metadata if metadata else GetCachedMetadata(kind)
+  if metadata and metadata.fields:
+    return metadata_conditional.GetAssembledConditionals(metadata)
+  return {}
+
+
 def GetConditionalOverrides(kind, entity):
   """Evaluates metadata conditional rules to determine metadata overrides.
 
@@ -321,12 +813,28 @@ def GetConditionalOverrides(kind, entity):
       override values. The returned dictionary will be empty if no metadata
       conditional rules evaluate as true.
   """
-  # First get the metadata.
-  metadata = GetMetadata(kind)
-  # Then get the assembled conditionals.
-  assembled_conditionals = metadata_conditional.GetAssembledConditionals(
-      metadata)
+  # First get the assembled conditionals, compiled once per metadata version.
+  assembled_conditionals = GetAssembledConditionalsCached(kind)
 
-  # Finally, resolve the conditionals and return any triggered overrides.
+  # Then resolve the conditionals and return any triggered overrides.
   return metadata_conditional.ResolveConditionals(entity,
                                                   assembled_conditionals)
+
+
+def GetConditionalOverridesMulti(kind, entities):
+  """Evaluates metadata conditional rules for many entities at once.
+
+  See GetConditionalOverrides for the format of the overrides.
+
+  Args:
+    kind: str, the model kind for rule evaluation.
+    entities: list of dicts, the entities to target during metadata rule
+      evaluation.
+
+  Returns:
+    list of dicts, the metadata overrides for each entity, in the same order as
+      entities.
+  """
+  assembled_conditionals = GetAssembledConditionalsCached(kind)
+  return metadata_conditional.ResolveConditionalsMulti(
+      entities, assembled_conditionals)
@@ -0,0 +1,79 @@
+"""Benchmarks merging model-defined metadata for a hierarchy of models.
+
+Compares the per-call merge of Meta class and property defaults, as
+ApplyModelDefinedMetadata used to do it, with the options precomputed per
+class by metadata_api._GetStaticOptions. Both include the cost of copying the
+datastore metadata they are applied to, which is shown separately.
+
+Usage:
+
+  python -m _base.metadata.metadata_api_benchmark
+"""
+
+from google.appengine.ext import ndb
+
+from _base.common import common_models
+from _base.metadata import metadata_api
+from _base.metadata import metadata_messages
+from _base.metadata import metadata_models
+from _base.metadata import metadata_utils
+from _base.utils import benchmark_utils
+
+_DEPTHS = (1, 3, 6)
+_FIELDS_PER_CLASS = 10
+
+
+def _CreateHierarchy(depth):
+  """Returns the leaf class of a chain of BaseModel subclasses."""
+  cls = common_models.BaseModel
+  for level in xrange(depth):
+    names = ['level%d_field%d' % (level, i) for i in xrange(_FIELDS_PER_CLASS)]
+    meta = type('Meta', (object,), {'fields': {
+        name: {'display_order': i, 'index_for_search': False}
+        for i, name in enumerate(names)}})
+    classdict = {name: ndb.StringProperty() for name in names[:2]}
+    classdict['Meta'] = meta
+    cls = type('BenchmarkDepth%dLevel%d' % (depth, level), (cls,), classdict)
+  return cls
+
+
+def _ApplyPerCall(cls, metadata):
+  """The merge of model-defined metadata before it was precomputed."""
+  for base_cls in reversed(cls.mro()):
+    if isinstance(base_cls, metadata_models.MetadataMetaModel):
+      base_kind = base_cls._get_kind()  # pylint: disable=protected-access
+      defaults = metadata_models.METADATA_DEFAULTS.get(base_kind)
+      if defaults:
+        metadata_utils.UpdateMetadata(metadata, defaults)
+  fields = metadata_utils.GetModelDefaults(
+      cls._properties)  # pylint: disable=protected-access
+  if fields:
+    metadata_utils.UpdateMetadata(metadata, {'fields': fields})
+
+
+def _ApplyPrecomputed(cls, metadata):
+  # pylint: disable=protected-access
+  for options in metadata_api._GetStaticOptions(cls):
+    metadata_utils.UpdateMetadata(metadata, options)
+
+
+def main():
+  rows = []
+  for depth in _DEPTHS:
+    cls = _CreateHierarchy(depth)
+    metadata = metadata_messages.Metadata(
+        kind=cls._get_kind())  # pylint: disable=protected-access
+    clone = benchmark_utils.Time(
+        lambda: metadata_utils.CloneMetadata(metadata))
+    per_call = benchmark_utils.Time(
+        lambda: _ApplyPerCall(cls, metadata_utils.CloneMetadata(metadata)))
+    precomputed = benchmark_utils.Time(
+        lambda: _ApplyPrecomputed(cls, metadata_utils.CloneMetadata(metadata)))
+    rows.append([depth, len(cls.mro()), clone, per_call, precomputed])
+  benchmark_utils.PrintTable(
+      'Model-defined metadata merge (us)',
+      ['depth', 'mro', 'copy', 'per call', 'precomputed'], rows)
+
+
+if __name__ == '__main__':
+  main()
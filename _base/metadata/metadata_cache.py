@@ -0,0 +1,129 @@
+"""Process-wide cache for metadata and values derived from metadata.
+
+Entries are stored per (namespace, kind) and are only valid for the metadata
+version they were stored under. The version is a generation counter kept in
+memcache and bumped whenever a Metadata entity is written or deleted, so every
+instance drops its stale entries on the first request that sees the new
+version. The version itself is read at most once per request.
+
+Cached values are shared between requests and threads and must be treated as
+read-only.
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from _base.utils import constants
+from _base.utils import request_state
+
+
+# Returned by Get() when nothing is cached, since None is a valid value.
+MISSING = object()
+
+_VERSION_VAR = 'metadata_cache_version'
+
+_lock = threading.Lock()
+_entries = {}
+_entries_version = None
+_hits = collections.Counter()
+_misses = collections.Counter()
+
+
+def _InitialVersion():
+  """Returns a seed version that is newer than any previously issued one."""
+  return int(time.time() * 1000)
+
+
+def GetVersion():
+  """Returns the current metadata version.
+
+  Returns:
+    int, the metadata generation counter for this request.
+  """
+  version = request_state.GetRequestVar(_VERSION_VAR)
+  if version is None:
+    key = constants.METADATA_VERSION_MEMCACHE_KEY
+    version = memcache.get(key)
+    if version is None:
+      version = _InitialVersion()
+      if not memcache.add(key, version):
+        version = memcache.get(key) or version
+    request_state.SetRequestVar(_VERSION_VAR, version)
+  return version
+
+
+def BumpVersion():
+  """Invalidates cached metadata on all instances."""
+  key = constants.METADATA_VERSION_MEMCACHE_KEY
+  version = memcache.incr(key, initial_value=_InitialVersion())
+  if version is None:
+    # Readers will seed a fresh version from the clock.
+    memcache.delete(key)
+  request_state.SetRequestVar(_VERSION_VAR, version)
+  Clear()
+
+
+def Clear():
+  """Drops all locally cached entries."""
+  global _entries_version
+  with _lock:
+    _entries.clear()
+    _entries_version = None
+
+
+def Get(namespace, kind):
+  """Returns a cached value for the current metadata version.
+
+  Args:
+    namespace: str, the type of cached value.
+    kind: str, the model kind.
+
+  Returns:
+    The cached value, or MISSING if there is none.
+  """
+  version = GetVersion()
+  with _lock:
+    value = MISSING
+    if version == _entries_version:
+      value = _entries.get((namespace, kind), MISSING)
+    if value is MISSING:
+      _misses[namespace] += 1
+    else:
+      _hits[namespace] += 1
+    return value
+
+
+def Set(namespace, kind, value):
+  """Caches a value for the current metadata version.
+
+  Values computed by requests that started before the latest version was seen
+  are discarded.
+
+  Args:
+    namespace: str, the type of cached value.
+    kind: str, the model kind.
+    value: *, the value to cache.
+  """
+  global _entries_version
+  version = GetVersion()
+  with _lock:
+    if _entries_version is None or version > _entries_version:
+      _entries.clear()
+      _entries_version = version
+    if version == _entries_version:
+      _entries[(namespace, kind)] = value
+
+
+def GetStats():
+  """Returns cache hit and miss counters since the instance started.
+
+  Returns:
+    dict<str, dict>, namespace to a dict with 'hits' and 'misses' counts.
+  """
+  with _lock:
+    return {namespace: {'hits': _hits[namespace], 'misses': _misses[namespace]}
+            for namespace in set(_hits) | set(_misses)}
+
@@ -1,13 +1,21 @@
 """Classes and functions to support conditional metadata settings."""
 
+import datetime
 import logging
+import operator
 import StringIO
 import tokenize
 
+try:
+  import numpy  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numpy = None
+
 from _base.errors import error_msg
 from _base.metadata import metadata_messages
 from _base.metadata import metadata_utils
 from _base.utils import conversion_utils
+from _base.utils import lru_cache
 
 
 # Boolean type metadata field properties.
@@ -39,6 +47,26 @@ CONDITIONAL_FLOAT_DATATYPES = {'FLOAT', 'DECIMAL',}
 # The supported operations for conditional rules.
 SUPPORTED_OPERATIONS = {'==', '!=', '>', '>=', '<', '<='}
 
+# Comparison functions for the supported operations.
+_OPERATOR_MAP = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+# Parsed (field, op, value) tokens by rule string, shared by all metadata.
+_PARSED_RULES = lru_cache.LruCache(2000)
+
+# Minimum number of values for which batch comparisons use NumPy arrays.
+_NUMPY_MIN_VALUES = 64
+_NUMERIC_TYPES = frozenset([int, long, float])
+# Integers up to this magnitude are exactly representable as floats.
+_MAX_EXACT_FLOAT_INT = 2 ** 53
+_EPOCH = datetime.datetime.utcfromtimestamp(0)
+
 # The Metadata properties allowed to be overridden.
 ALLOWED_METADATA_PROPERTY_OVERRIDES = {
     'required', 'convert_case', 'regex', 'ui_hidden', 'ui_readonly'}
@@ -96,6 +124,100 @@ def CoerceRuleValueDatatype(string_val, metadata_field):
                      % metadata_field.property_type)
 
 
+def _ToNumbers(values):
+  """Maps values to numbers preserving their order, if possible.
+
+  Args:
+    values: list, non-None values of a single field.
+
+  Returns:
+    list of numbers, or None if the values aren't all numbers, all dates or all
+        naive datetimes.
+  """
+  value_type = type(values[0])
+  if value_type in _NUMERIC_TYPES:
+    if all(type(v) in _NUMERIC_TYPES for v in values):
+      return values
+  elif value_type is datetime.date:
+    if all(type(v) is datetime.date for v in values):
+      return [v.toordinal() for v in values]
+  elif value_type is datetime.datetime:
+    if all(type(v) is datetime.datetime and v.tzinfo is None for v in values):
+      deltas = [v - _EPOCH for v in values]
+      return [(d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+              for d in deltas]
+  return None
+
+
+def _ToArray(numbers):
+  """Returns a NumPy array of numbers that compares exactly like them, or None.
+
+  Integers are only converted to floats if that is exact, since Python compares
+  integers with floats exactly. Integers beyond 64 bits are not converted.
+
+  Args:
+    numbers: list of numbers, as returned by _ToNumbers.
+
+  Returns:
+    numpy.ndarray of int64 or float64, or None.
+  """
+  array = numpy.array(numbers)
+  if array.dtype.kind == 'i':
+    return array
+  if array.dtype.kind == 'f' and all(
+      type(n) is float or -_MAX_EXACT_FLOAT_INT <= n <= _MAX_EXACT_FLOAT_INT
+      for n in numbers):
+    return array
+  return None
+
+
+def _CompareColumn(compare, values, rule_value):
+  """Compares every value with a rule value.
+
+  Args:
+    compare: function, the comparison operator.
+    values: list, non-None values of a single field.
+    rule_value: obj, the coerced rule value.
+
+  Returns:
+    list of booleans, the comparison results in the order of values.
+  """
+  if numpy is not None and len(values) >= _NUMPY_MIN_VALUES:
+    numbers = _ToNumbers(values + [rule_value])
+    array = None if numbers is None else _ToArray(numbers)
+    if array is not None:
+      # The rule value is converted along with the values, so the comparison
+      # doesn't convert the values again.
+      return compare(array[:-1], array[-1]).tolist()
+  return [bool(compare(value, rule_value)) for value in values]
+
+
+def _GetColumn(entities, field_name):
+  """Returns the values of a field for many entities or dicts."""
+  return [entity.get(field_name) if isinstance(entity, dict)
+          else getattr(entity, field_name, None) for entity in entities]
+
+
+def _ParseRule(rule_string):
+  """Splits a rule string into its tokens.
+
+  Args:
+    rule_string: string, the rule in string form.
+
+  Returns:
+    (field, op, value) tuple of strings, or None if the rule is malformed.
+  """
+  parsed = _PARSED_RULES.Get(rule_string)
+  if parsed is lru_cache.MISSING:
+    tokens = tokenize.generate_tokens(StringIO.StringIO(rule_string).readline)
+    try:
+      parsed = (next(tokens)[1], next(tokens)[1], next(tokens)[1])
+    except StopIteration:
+      parsed = None
+    _PARSED_RULES.Set(rule_string, parsed)
+  return parsed
+
+
 class AssembledRule(object):
   """A representation of an individual conditional rule."""
 
@@ -110,18 +232,16 @@ class AssembledRule(object):
     Raises:
       ValueError: Upon a failed attempt to parse the rule_string.
     """
-    tokens = tokenize.generate_tokens(StringIO.StringIO(rule_string).readline)
-
-    try:
-      self.field = next(tokens)[1]
-      self.op = next(tokens)[1]
-      self.value = next(tokens)[1]
-    except StopIteration:
+    parsed = _ParseRule(rule_string)
+    if parsed is None:
       msg = error_msg.MALFORMED_CONDITIONAL_RULE % (rule_string, metadata.kind)
       logging.error(msg)
       raise ValueError(msg)
 
+    self.field, self.op, self.value = parsed
     self.metadata = metadata
+    # (operator function, coerced rule value), resolved on first evaluation.
+    self._compiled = None
 
   def __str__(self):
     return 'AssembledRule(field: %s, op: %s, value: %s)' % (
@@ -130,6 +250,27 @@ class AssembledRule(object):
   def __repr__(self):
     return self.__str__()
 
+  def _Compile(self):
+    """Resolves the operator function and rule value for evaluation.
+
+    Returns:
+      (function, obj), the comparison function and the coerced rule value.
+
+    Raises:
+      ValueError: Raised if an unknown opcode is detected.
+    """
+    if self._compiled is None:
+      field_properties = metadata_utils.GetFieldByName(
+          self.metadata, self.field)
+      rule_value = CoerceRuleValueDatatype(self.value, field_properties)
+      compare = _OPERATOR_MAP.get(self.op)
+      if compare is None:
+        msg = 'The rule operation code "%s" is invalid.' % self.op
+        logging.error(msg)
+        raise ValueError(msg)
+      self._compiled = (compare, rule_value)
+    return self._compiled
+
   def Evaluate(self, entity):
     """Evaluate a given rule to determine the truth value.
 
@@ -152,30 +293,40 @@ class AssembledRule(object):
     if field_value is None:
       return False  # If there is no entity value, rule resolves to False.
 
-    field_properties = metadata_utils.GetFieldByName(self.metadata, self.field)
-    rule_value = CoerceRuleValueDatatype(self.value, field_properties)
+    compare, rule_value = self._Compile()
 
     # If either field or rule value is None, then no valid
     # comparison is possible. Note: if both are None, then comparison may occur.
     if (field_value is None) ^ (rule_value is None):
       return
 
-    if self.op == '==':
-      return field_value == rule_value
-    elif self.op == '!=':
-      return field_value != rule_value
-    elif self.op == '>':
-      return field_value > rule_value
-    elif self.op == '>=':
-      return field_value >= rule_value
-    elif self.op == '<':
-      return field_value < rule_value
-    elif self.op == '<=':
-      return field_value <= rule_value
-    else:
-      msg = 'The rule operation code "%s" is invalid.' % self.op
-      logging.error(msg)
-      raise ValueError(msg)
+    return compare(field_value, rule_value)
+
+  def EvaluateMulti(self, column):
+    """Evaluate the rule for many entities at once.
+
+    Args:
+      column: list, the values of the rule field, one for each entity.
+
+    Returns:
+      list of booleans, True for each value that meets the rule condition.
+
+    Raises:
+      ValueError: Raised if an unknown opcode is detected.
+    """
+    results = [False] * len(column)
+    present = [i for i, value in enumerate(column) if value is not None]
+    if not present:
+      return results  # Values of None always resolve to False.
+
+    compare, rule_value = self._Compile()
+    if rule_value is None:
+      return results  # No valid comparison is possible.
+
+    matches = _CompareColumn(compare, [column[i] for i in present], rule_value)
+    for i, match in zip(present, matches):
+      results[i] = match
+    return results
 
   def Validate(self):
     """This method will test if the rule is valid.
@@ -319,6 +470,25 @@ class AssembledConditional(object):
     else:
       return {}
 
+  def EvaluateMulti(self, columns, count):
+    """Test many entities for possible triggering of conditional rules.
+
+    Args:
+      columns: dict, field names with lists of values, one for each entity.
+        Must contain the fields of all rules.
+      count: int, the number of entities.
+
+    Returns:
+      list of booleans, True for each entity that meets all rule conditions.
+    """
+    condition_met = [True] * count
+    for rule in self.rules:
+      if not any(condition_met):
+        break
+      rule_met = rule.EvaluateMulti(columns[rule.field])
+      condition_met = [a and b for a, b in zip(condition_met, rule_met)]
+    return condition_met
+
   def Validate(self):
     """This method will test if the conditional is valid.
 
@@ -437,3 +607,42 @@ def ResolveConditionals(entity, conditionals):
       metadata_overrides[field_name] = field_overrides
 
   return metadata_overrides
+
+
+def ResolveConditionalsMulti(entities, conditionals):
+  """Resolve conditionals against many entities at once.
+
+  Each rule is evaluated for all entities in one pass over the values of its
+  field, which avoids repeating the per-entity overhead of ResolveConditionals
+  on large imports and listings.
+
+  Args:
+    entities: list of ndb.Model|dict, the entities to target during
+      conditional resolution.
+    conditionals: metadata_conditional.AssembledCondition.
+
+  Returns:
+    list of dicts, the result of ResolveConditionals for each entity, in the
+      same order as entities.
+  """
+  entities = list(entities)
+  count = len(entities)
+  columns = {}
+  for assembled_conditions in conditionals.itervalues():
+    for assembled_condition in assembled_conditions:
+      for rule in assembled_condition.rules:
+        if rule.field not in columns:
+          columns[rule.field] = _GetColumn(entities, rule.field)
+
+  metadata_overrides = [{} for _ in xrange(count)]
+  for field_name, assembled_conditions in conditionals.iteritems():
+    for assembled_condition in assembled_conditions:
+      if not assembled_condition.overrides:
+        continue
+      condition_met = assembled_condition.EvaluateMulti(columns, count)
+      for overrides, met in zip(metadata_overrides, condition_met):
+        if met:
+          overrides.setdefault(field_name, {}).update(
+              assembled_condition.overrides)
+
+  return metadata_overrides
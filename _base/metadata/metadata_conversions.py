@@ -1,11 +1,18 @@
 """Metadata utils for converting values to metadata types in Double Helix."""
 
+import decimal
+import re
 
 from _base.errors import error_msg
 from _base.metadata import metadata_messages
 from _base.utils import conversion_utils
 from _base.utils import json_utils
 
+try:
+  import numpy  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numpy = None
+
 
 CONVERTERS = {
     metadata_messages.PropertyType.BOOLEAN: conversion_utils.ToBool,
@@ -48,6 +55,108 @@ def Convert(value, value_type):
         error_msg.METADATA_CONVERSION % (value, value_type))
 
 
+# Errors raised by converters for bad values, see Convert.
+_CONVERSION_ERRORS = (conversion_utils.ConversionError, LookupError, TypeError,
+                      ValueError, AttributeError, NameError, ArithmeticError)
+
+# Minimum number of values for which columns are parsed with NumPy.
+_NUMPY_MIN_VALUES = 64
+
+# NumPy types used to parse columns of strings, see ConvertColumn.
+_NUMPY_DTYPES = {
+    metadata_messages.PropertyType.FLOAT: 'float64',
+    metadata_messages.PropertyType.INTEGER: 'int64',
+}
+
+# Currency conversion, see conversion_utils.ToCurrency.
+_CURRENCY_CONTEXT = decimal.Context(rounding=decimal.ROUND_HALF_UP)
+_CURRENCY_DEFAULT = decimal.Decimal('0.00')
+_CURRENCY_PRECISION = decimal.Decimal('0.01')
+_CURRENCY_STRIP = re.compile(r'[^0-9.\-]+')
+
+
+def _ConvertEach(values, converter):
+  """Converts values one by one.
+
+  Args:
+    values: list, the values to convert.
+    converter: function, converts a single value.
+
+  Returns:
+    (converted, errors) tuple, see ConvertColumn.
+  """
+  converted = []
+  errors = []
+  append = converted.append
+  for i, value in enumerate(values):
+    try:
+      append(converter(value))
+    except _CONVERSION_ERRORS:
+      append(None)
+      errors.append(i)
+  return converted, errors
+
+
+def _ToCurrency(value):
+  """Converts a value like conversion_utils.ToCurrency with a shared context."""
+  if not isinstance(value, decimal.Decimal):
+    try:
+      value = decimal.Decimal(_CURRENCY_STRIP.sub('', str(value)))
+    except (ValueError, decimal.InvalidOperation):
+      value = _CURRENCY_DEFAULT
+  return unicode(_CURRENCY_CONTEXT.quantize(value, _CURRENCY_PRECISION))
+
+
+def _ParseWithNumpy(values, dtype):
+  """Parses a column of strings with NumPy.
+
+  Args:
+    values: list, the values to convert.
+    dtype: str, the NumPy type to parse into.
+
+  Returns:
+    list of converted values, or None if any value can't be parsed, in which
+    case values must be converted one by one.
+  """
+  if not all(isinstance(value, basestring) for value in values):
+    return None
+  try:
+    return numpy.array(values).astype(dtype).tolist()
+  except (ValueError, TypeError, OverflowError):
+    return None
+
+
+def ConvertColumn(values, value_type):
+  """Converts many values to value_type.
+
+  This is equivalent to calling Convert for every value, but avoids most of
+  the per-value overhead. Columns of strings are parsed with NumPy for INTEGER
+  and FLOAT, if available.
+
+  Args:
+    values: list, the values to convert.
+    value_type: str, the type in CONVERTERS if type isn't found assume unicode.
+
+  Returns:
+    (converted, errors) tuple, the list of converted values, with None for
+    values that could not be converted, and the list of the positions of those
+    values.
+  """
+  values = list(values)
+  converter = CONVERTERS.get(value_type)
+  if converter is None:
+    return values, []
+  if value_type in (metadata_messages.PropertyType.CURRENCY,
+                    metadata_messages.PropertyType.COMPUTED_CURRENCY):
+    return _ConvertEach(values, _ToCurrency)
+  dtype = _NUMPY_DTYPES.get(value_type)
+  if dtype and numpy is not None and len(values) >= _NUMPY_MIN_VALUES:
+    converted = _ParseWithNumpy(values, dtype)
+    if converted is not None:
+      return converted, []
+  return _ConvertEach(values, converter)
+
+
 def MaybeToString(value):
   """JSON encodes a value if it isn't already a string."""
   return value if isinstance(value, basestring) else json_utils.Dump(value)
@@ -84,6 +84,17 @@ class BigQueryTransform(messages.Enum):
   JSON = 2
 
 
+class ReadMode(messages.Enum):
+  """Valid read_mode values.
+
+  QUERY reads entities straight from the query. KEYS_THEN_GET runs a keys-only
+  query and reads the entities by key, so entities in the ndb context cache or
+  memcache are not read from the datastore.
+  """
+  QUERY = 1
+  KEYS_THEN_GET = 2
+
+
 class MetadataFormField(messages.Message):
   """A field in form."""
   name = messages.StringField(1, required=True)
@@ -262,7 +273,13 @@ class MetadataField(messages.Message):
   trigger = messages.MessageField(DataPropagationTrigger, 35, repeated=True)
   ui_date_pattern = messages.StringField(37)
   ui_column_max_width = messages.IntegerField(38)
-  # Next ID: 39.
+  # Compression of JSON values: the zlib level (0-9) and the total size in bytes
+  # of a property's values above which they are compressed.
+  json_compression_level = messages.IntegerField(
+      39, variant=messages.Variant.UINT32)
+  json_compression_threshold = messages.IntegerField(
+      40, variant=messages.Variant.UINT32)
+  # Next ID: 41.
 
 
 class MetadataLink(messages.Message):
@@ -333,7 +350,11 @@ class Metadata(messages.Message):
   access_type = messages.StringField(
       20, default=permission_models.AccessType.TABLE_WRITE_ONLY.value)
   force_delete = messages.BooleanField(21, default=False)
-  # Next index 39
+  read_mode = messages.EnumField(ReadMode, 39, default=ReadMode.QUERY)
+  # Validate entities against the field rules on every put. Stored entities
+  # that break the rules can then no longer be put.
+  validate_on_put = messages.BooleanField(40, default=False)
+  # Next index 41
 
 LIST_METADATA_REQUEST = endpoints.ResourceContainer(
     kinds_only=messages.BooleanField(
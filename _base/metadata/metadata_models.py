@@ -23,15 +23,18 @@ See MetadataField and Metadata class in metadata_messages for all possible
 metadata settings.
 """
 
-import cPickle as pickle
 import logging
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 
+from _base.errors import error_collector
+from _base.metadata import metadata_cache
 from _base.metadata import metadata_messages
 from _base.metadata import metadata_utils
+from _base.utils import constants
 from _base.utils import request_state
 from _base.utils import signals
 
@@ -63,13 +66,45 @@ class Metadata(signals.SignalMixin, ndb.Model):
     ctx_options['backup'] = ctx_options.get('backup', True)
     return super(Metadata, self).put_async(**ctx_options)
 
+  def _post_put_hook(self, future):  # pylint: disable=g-bad-name
+    """Invalidates cached metadata once the write is committed."""
+    super(Metadata, self)._post_put_hook(future)
+    ctx = ndb.get_context()
+    if not future.get_exception():
+      kind, metadata = self.key.string_id(), self.metadata
+      ctx.call_on_commit(lambda: _UpdateKindCatalog(kind, metadata))
+    ctx.call_on_commit(metadata_cache.BumpVersion)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):  # pylint: disable=g-bad-name
+    """Invalidates cached metadata once the delete is committed."""
+    super(Metadata, cls)._post_delete_hook(key, future)
+    ctx = ndb.get_context()
+    if not future.get_exception():
+      kind = key.string_id()
+      ctx.call_on_commit(lambda: _UpdateKindCatalog(kind, None))
+    ctx.call_on_commit(metadata_cache.BumpVersion)
+
+
+def _UpdateKindCatalog(kind, metadata):
+  """Updates the cached summary of a kind after its metadata changed."""
+  # Avoid circular import, pylint: disable=g-import-not-at-top
+  from _base.metadata import metadata_api
+  # pylint: enable=g-import-not-at-top
+  try:
+    metadata_api.UpdateKindCatalog(kind, metadata)
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('Unable to update the kind catalog for %s', kind)
+    memcache.delete(constants.METADATA_CATALOG_MEMCACHE_KEY)
+
 
 class MetadataMetaModel(ndb.MetaModel):
   """Metaclass for MetadataModel.
 
   This metaclass provides a thread-local "_meta" property to model classes. The
-  metadata is loaded from the datastore the first time it is accessed in a
-  request/thread.
+  metadata is taken from the process-wide metadata cache the first time it is
+  accessed in a request/thread. The cached instance is shared, so it is copied
+  the first time it is modified through the "_meta" setter (copy-on-write).
 
   If a model class has a nested class named "Meta", it will be used for defaults
   and will override any settings defined in the datastore. But note that any
@@ -104,7 +139,7 @@ class MetadataMetaModel(ndb.MetaModel):
       # Avoid circular import, pylint: disable=g-import-not-at-top
       from _base.metadata import metadata_api
       # pylint: enable=g-import-not-at-top
-      metadata = metadata_api.GetMetadata(kind)
+      metadata = metadata_api.GetCachedMetadata(kind)
       rs[kind] = metadata
     return metadata
 
@@ -112,11 +147,19 @@ class MetadataMetaModel(ndb.MetaModel):
   def _meta(cls, metadata):
     """Overrides thread-local model metadata. If a dict, it's merged instead."""
     kind = cls._get_kind()  # pylint: disable=protected-access
+    rs = request_state.GetRequestState('metadata')
+    owned = request_state.GetRequestState('metadata_owned')
     if isinstance(metadata, dict):
-      metadata_utils.UpdateMetadata(cls._meta, metadata)
+      current = cls._meta
+      if not owned.get(kind):
+        # Never modify the shared, cached instance.
+        current = metadata_utils.CloneMetadata(current)
+        rs[kind] = current
+        owned[kind] = True
+      metadata_utils.UpdateMetadata(current, metadata)
     else:
-      rs = request_state.GetRequestState('metadata')
       rs[kind] = metadata
+      owned[kind] = True
 
 
 # Create a mapping of field property types to _db_get_value methods.
@@ -169,9 +212,49 @@ class MetadataModel(signals.SignalMixin, ndb.Model):
         raise
 
   def _pre_put_hook(self):
-    """Checks for uninitialized required properties."""
+    """Checks for uninitialized required properties.
+
+    Kinds whose metadata sets validate_on_put are also checked for invalid
+    values.
+    """
     super(MetadataModel, self)._pre_put_hook()
     self._check_initialized(ignore=False)
+    if getattr(self._get_meta_view(), 'validate_on_put', False):
+      self._validate_row().RaiseIfAny(datastore_errors.BadValueError)
+
+  def _validate_row(self, errors=None):
+    """Validates and normalizes the metadata-defined values of this instance.
+
+    The metadata field rules (required, regex, choices, range, unique, case,
+    whitespace and decimal digits) of the class metadata are compiled once per
+    kind and metadata version, see metadata_validator.RowValidator. Changes to
+    the metadata of this instance are ignored, so that no validator is compiled
+    per entity. Values are normalized in place.
+
+    Note: This method uses PEP-8 naming to be consistent with _clone_properties.
+
+    Args:
+      errors: error_collector.Errors, collects the problems found, a new
+          instance is used if omitted.
+
+    Returns:
+      error_collector.Errors, the problems found, keyed by field name.
+    """
+    # Avoid circular import, pylint: disable=g-import-not-at-top
+    from _base.metadata import metadata_api
+    # pylint: enable=g-import-not-at-top
+    validator = metadata_api.GetRowValidatorCached(
+        self._get_kind(),
+        self.__class__._meta)  # pylint: disable=protected-access
+    if validator is None:
+      return errors if errors is not None else error_collector.Errors()
+    row = {name: getattr(self, name, None) for name in validator.field_names}
+    original = dict(row)
+    errors = validator(row, errors=errors)
+    for name, value in row.iteritems():
+      if value is not original[name] and value != original[name]:
+        setattr(self, name, value)
+    return errors
 
   @classmethod
   def _unknown_property(cls, name):
@@ -199,7 +282,7 @@ class MetadataModel(signals.SignalMixin, ndb.Model):
   def _populate_properties(self):
     """Initializes metadata properties."""
     missing = []
-    for field in self._meta.fields:
+    for field in self._get_meta_view().fields:
       prop = self._properties.get(field.name)
       if prop is None or (
           type(prop) != metadata_messages.PROPERTY_MAP[field.property_type]):
@@ -212,27 +295,56 @@ class MetadataModel(signals.SignalMixin, ndb.Model):
           self._properties[field.name] = prop
 
   def _clone_meta(self):
-    """Helper to clone self._meta if necessary.
+    """Helper to give this instance its own view of self._meta if necessary.
 
     Call this before mutating _meta if you want the changes to only affect a
-    single model instance.
+    single model instance. The view is a copy-on-write overlay, so only the
+    fields that are actually changed are copied.
 
     Note: This method uses PEP-8 naming to be consistent with _clone_properties.
     """
     cls_meta = self.__class__._meta  # pylint: disable=protected-access
-    if self._meta is cls_meta:
-      # cPickle is considerably faster than both copy.deepcopy and protojson.
-      self._meta = pickle.loads(pickle.dumps(cls_meta, pickle.HIGHEST_PROTOCOL))
+    if self._get_meta_view() is cls_meta:
+      self._meta_view = metadata_utils.MetadataOverlay(cls_meta)
+
+  def _get_meta_view(self):
+    """Returns the metadata of this instance, possibly a MetadataOverlay.
+
+    Internal lookups go through the view so that per-instance changes don't
+    copy the class metadata. Use "_meta" to get a metadata message.
+
+    Note: This method uses PEP-8 naming to be consistent with _clone_properties.
+    """
+    view = self.__dict__.get('_meta_view')
+    if view is None:
+      view = self.__class__._meta  # pylint: disable=protected-access
+    return view
+
+  @property
+  def _meta(self):
+    """Returns the metadata of this instance as a metadata message.
+
+    An instance with its own changes is given a private copy of the metadata
+    the first time this is read, see MetadataOverlay.AsMessage().
+    """
+    view = self._get_meta_view()
+    if isinstance(view, metadata_utils.MetadataOverlay):
+      return view.AsMessage()
+    return view
+
+  @_meta.setter
+  def _meta(self, metadata):
+    """Replaces the metadata of this instance."""
+    self._meta_view = metadata
 
   def __getattr__(self, name):
     """Returns a metadata-defined property value."""
-    if name == '_meta':
-      return self.__class__._meta  # pylint: disable=protected-access
     if name.startswith('_'):
       return super(MetadataModel, self).__getattr__(name)
     prop = self._properties.get(name)
     if prop is None:
-      if metadata_utils.GetFieldByName(self._meta, name) is not None:
+      if metadata_utils.GetFieldByName(
+          self._get_meta_view(), name) is not None:
         return  # Don't fail if the property hasn't been created yet.
       return super(MetadataModel, self).__getattribute__(name)
     return prop._get_value(self)  # pylint: disable=protected-access
@@ -241,14 +353,14 @@ class MetadataModel(signals.SignalMixin, ndb.Model):
     """Sets a metadata-defined property value."""
     if name == '_meta' and isinstance(value, dict):
       self._clone_meta()
-      return metadata_utils.UpdateMetadata(self._meta, value)
+      return metadata_utils.UpdateMetadata(self._get_meta_view(), value)
     attr = getattr(self.__class__, name, None)
     if name.startswith('_') or isinstance(attr, (ndb.Property, property)):
       if not isinstance(attr, ndb.ComputedProperty):
         super(MetadataModel, self).__setattr__(name, value)
       return
     self._clone_properties()
-    field = metadata_utils.GetFieldByName(self._meta, name)
+    field = metadata_utils.GetFieldByName(self._get_meta_view(), name)
     repeated = isinstance(value, list)
     # Foreign Key propagation needs to be able to dynamically change the
     # repeated flag on a property.
@@ -258,7 +370,7 @@ class MetadataModel(signals.SignalMixin, ndb.Model):
           repeated and value and isinstance(value[0], (ndb.Model, dict))):
         defaults['property_type'] = metadata_messages.PropertyType.STRUCT
       self._meta = {'fields': {name: defaults}}
-      field = metadata_utils.GetFieldByName(self._meta, name)
+      field = metadata_utils.GetFieldByName(self._get_meta_view(), name)
     prop = metadata_utils.GetFieldProperty(field)
     if prop:
       self._properties[name] = prop
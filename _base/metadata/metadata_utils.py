@@ -1,9 +1,10 @@
 """Metadata utilities for Double Helix app."""
 
 import copy
+import cPickle as pickle
+import hashlib
 import logging
 import operator
-import uuid
 
 from google.appengine.ext import ndb
 
@@ -13,6 +14,8 @@ from _base.errors import error_msg
 from _base.metadata import metadata_conversions
 from _base.metadata import metadata_messages
 from _base.utils import constants
+from _base.utils import lru_cache
+from _base.utils import model_utils
 from _base.utils import yaml_utils
 
 _KIND_FILENAME_DICT = None
@@ -21,6 +24,13 @@ _KIND_FILENAME_DICT = None
 # the datastore to be reset to the default.
 RESET = object()
 
+# Instance attribute holding the field name index of a metadata instance.
+_FIELD_INDEX_ATTR = '_field_index'
+
+# Maximum number of interned field properties and structured sub-models.
+_MAX_FIELD_PROPERTIES = 5000
+_MAX_STRUCT_MODELS = 1000
+
 # Reverse property mapping.
 _PROPERTY_RMAP = {p: metadata_messages.PropertyType(n[0])
                   for p, n in metadata_messages.PROPERTY_TYPES.iteritems()}
@@ -127,13 +137,153 @@ SAMPLE_METADATA = metadata_messages.Metadata(
     }])
 
 
+def CloneMetadata(metadata):
+  """Returns a deep copy of a metadata message.
+
+  Args:
+    metadata: messages.Message instance, the message to copy.
+
+  Returns:
+    A new message instance.
+  """
+  # cPickle is considerably faster than both copy.deepcopy and protojson.
+  return pickle.loads(pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL))
+
+
+class MetadataOverlay(object):
+  """Copy-on-write view of shared metadata for a single model instance.
+
+  Only fields that are changed through Update() are copied, everything else is
+  read through to the shared metadata. Changing any other setting copies the
+  shared metadata once, after which all changes are applied to that copy.
+
+  The overlay is not a message. APIs that need one (encoding, isinstance checks,
+  copies) must be given AsMessage(), which MetadataModel._meta returns.
+
+  The "fields" attribute is merged once per change and must not be modified
+  directly, use UpdateMetadata() instead.
+  """
+
+  def __init__(self, metadata):
+    """Initialization of a MetadataOverlay.
+
+    Args:
+      metadata: metadata_messages.Metadata, the shared metadata to read from.
+    """
+    self._base = metadata
+    self._owns_base = False
+    # Mapping of field names to private field copies, or None if removed.
+    self._overrides = {}
+    # The merged fields list, or None if it must be rebuilt.
+    self._fields = None
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self._base, name)
+
+  def __repr__(self):
+    return '<MetadataOverlay %r overrides: %s>' % (
+        self._base.kind, sorted(self._overrides))
+
+  @property
+  def fields(self):
+    """Returns the merged list of fields, sorted like metadata fields."""
+    if not self._overrides:
+      return self._base.fields
+    if self._fields is not None:
+      return self._fields
+    fields = []
+    for field in self._base.fields:
+      field = self._overrides.get(field.name, field)
+      if field is not None:
+        fields.append(field)
+    base_index = _GetFieldIndex(self._base)
+    fields.extend(f for n, f in self._overrides.iteritems()
+                  if f is not None and n not in base_index)
+    SortFields(fields)
+    self._fields = fields
+    return fields
+
+  @property
+  def shared(self):
+    """Returns the shared metadata if the view has no changes, else None."""
+    if self._owns_base or self._overrides:
+      return None
+    return self._base
+
+  def AsMessage(self):
+    """Returns the view as a metadata message.
+
+    This is the shared metadata if the view has no changes. Otherwise the view
+    is first replaced with a private, merged copy, which is returned and which
+    any later changes are applied to.
+
+    Returns:
+      metadata_messages.Metadata, the metadata of the view.
+    """
+    if not self._owns_base and self._overrides:
+      self._Materialize()
+    return self._base
+
+  def GetField(self, name):
+    """Returns the field matching the given name, or None."""
+    if name in self._overrides:
+      return self._overrides[name]
+    return GetFieldByName(self._base, name)
+
+  def Update(self, options):
+    """Merges options into the view, see UpdateMetadata.
+
+    Args:
+      options: dict, the metadata options to be merged.
+    """
+    options = dict(options)
+    fields = options.pop('fields', None)
+    if not self._owns_base and (
+        options or (fields is not None and not isinstance(fields, dict))):
+      self._Materialize()
+    if self._owns_base:
+      if fields is not None:
+        options['fields'] = fields
+      UpdateMetadata(self._base, options)
+      return
+    self._fields = None
+    for name, field_opts in (fields or {}).iteritems():
+      if field_opts is RESET:
+        self._overrides[name] = None
+        continue
+      field = self.GetField(name)
+      if field is None:
+        field = _GetGenericField(name)
+      elif name not in self._overrides:
+        field = CloneMetadata(field)
+      UpdateMetadata(field, field_opts)
+      self._overrides[name] = field
+
+  def _Materialize(self):
+    """Replaces the shared metadata with a private, merged copy."""
+    fields = self.fields
+    self._base = CloneMetadata(self._base)
+    self._base.fields = [
+        f if f.name in self._overrides else GetFieldByName(self._base, f.name)
+        for f in fields]
+    _ResetFieldIndex(self._base)
+    self._owns_base = True
+    self._overrides = {}
+    self._fields = None
+
+
 def UpdateMetadata(metadata, options):
   """Recursively updates a metadata message with provided dict of values.
 
   Args:
-    metadata: metadata_messages.Metadata instance, the instance to update.
+    metadata: metadata_messages.Metadata instance, the instance to update. A
+        MetadataOverlay is updated without modifying the shared metadata.
     options: dict, the metadata options to be merged into the metadata instance.
   """
+  if isinstance(metadata, MetadataOverlay):
+    return metadata.Update(options)
   for key, value in options.iteritems():
     try:
       metadata_field = metadata.field_by_name(key)
@@ -150,7 +300,12 @@ def UpdateMetadata(metadata, options):
       # If we're merging a dict into a repeated field, assume it is a
       # repeated MessageField and that the message type has 'name' field.
       field_list = getattr(metadata, key)
-      field_map = {f.name: f for f in field_list}
+      if key == 'fields':
+        # Fields may have been renamed in place since the index was built.
+        _ResetFieldIndex(metadata)
+        field_map = _GetFieldIndex(metadata)
+      else:
+        field_map = {f.name: f for f in field_list}
       for field_name, field_opts in value.iteritems():
         field = field_map.get(field_name)
         if field_opts is RESET:
@@ -174,6 +329,8 @@ def UpdateMetadata(metadata, options):
         value = [metadata_conversions.MaybeToString(v)
                  for v in value if v is not None]
       setattr(metadata, key, value)
+    if key == 'fields':
+      _ResetFieldIndex(metadata)
 
 
 def ValidateMetadata(unused_prop, metadata):
@@ -248,9 +405,61 @@ def SortFields(fields):
   fields.sort(key=operator.attrgetter('display_order', 'name'))
 
 
+def _GetFieldIndexEntry(metadata):
+  """Returns the field name index entry of a metadata instance.
+
+  The entry is stored on the instance and rebuilt whenever the fields list is
+  replaced or changes size. UpdateMetadata, FixRenamedFields and
+  MetadataOverlay reset it after changing fields.
+
+  Args:
+    metadata: metadata_messages.Metadata or MetadataField instance.
+
+  Returns:
+    tuple, (fields list, its length, dict<str, MetadataField> of names to
+    fields, dict<str, int> of names to positions in the list).
+  """
+  fields = metadata.fields
+  index = getattr(metadata, _FIELD_INDEX_ATTR, None)
+  if index is None or index[0] is not fields or index[1] != len(fields):
+    field_map = {}
+    positions = {}
+    for i, field in enumerate(fields):
+      # Keep the first of any duplicates, like a linear scan would.
+      if field.name not in field_map:
+        field_map[field.name] = field
+        positions[field.name] = i
+    index = (fields, len(fields), field_map, positions)
+    # Messages reject assignment of attributes that aren't message fields.
+    object.__setattr__(metadata, _FIELD_INDEX_ATTR, index)
+  return index
+
+
+def _GetFieldIndex(metadata):
+  """Returns a mapping of field names to the fields of a metadata instance.
+
+  Args:
+    metadata: metadata_messages.Metadata or MetadataField instance.
+
+  Returns:
+    dict<str, metadata_messages.MetadataField>, the field name index.
+  """
+  return _GetFieldIndexEntry(metadata)[2]
+
+
+def _ResetFieldIndex(metadata):
+  """Drops the field name index of a metadata instance."""
+  vars(metadata).pop(_FIELD_INDEX_ATTR, None)
+
+
 def GetFieldByName(metadata, name):
   """Returns the metadata field matching the given name.
 
+  The field is checked against the list before it is returned, so the index is
+  rebuilt if the field was renamed, replaced or moved (e.g. by sorting) since
+  it was built. Code that renames or replaces a field in place must call
+  _ResetFieldIndex() before looking up the new name.
+
   Args:
     metadata: metadata_messages.Metadata instance, the instance to use.
     name: str, the name of the field to return.
@@ -258,7 +467,15 @@ def GetFieldByName(metadata, name):
   Returns:
     metadata_messages.MetadataField if found, otherwise None.
   """
-  return next((f for f in metadata.fields if f.name == name), None)
+  if isinstance(metadata, MetadataOverlay):
+    return metadata.GetField(name)
+  fields, unused_size, field_map, positions = _GetFieldIndexEntry(metadata)
+  field = field_map.get(name)
+  if field is not None and (
+      fields[positions[name]] is not field or field.name != name):
+    _ResetFieldIndex(metadata)
+    field = _GetFieldIndex(metadata).get(name)
+  return field
 
 
 _RENAMED_FIELDS = {
@@ -284,6 +501,7 @@ def FixRenamedFields(message):
       # pylint: enable=protected-access
   if getattr(message, 'fields', None):
     map(FixRenamedFields, message.fields)
+    _ResetFieldIndex(message)
 
 
 def _GetGenericField(name, **kwargs):
@@ -356,6 +574,11 @@ def GetPropertyFieldDefaults(prop):
     defaults['verbose_name'] = prop._verbose_name
   if isinstance(prop, ndb.ComputedProperty):
     defaults['ui_readonly'] = True
+  if isinstance(prop, model_utils.DHJsonProperty):
+    if prop._compression_level is not None:
+      defaults['json_compression_level'] = prop._compression_level
+    if prop._compression_threshold is not None:
+      defaults['json_compression_threshold'] = prop._compression_threshold
   # pylint: enable=protected-access
   return defaults
 
@@ -372,29 +595,65 @@ def GetFieldProperty(field):
   return _GetFieldPropertyCached(_GetPropertyAttrs(field))
 
 
-def MetadataDiff(kind, metadata1, metadata2):
+def _GetContentHashes(message, memo):
+  """Returns content hashes of a metadata or metadata field message.
+
+  Hashes are computed bottom-up, Merkle-style, so that identical subtrees can
+  be skipped without comparing them. Nested fields are hashed regardless of
+  their order. Equal hashes imply equal messages, unequal hashes don't imply
+  unequal messages (e.g. 1 and 1.0), so differences must be confirmed.
+
+  Args:
+    message: metadata_messages.Metadata|MetadataField, the message to hash.
+    memo: dict, hashes of already visited messages by id. Only valid as long as
+        the messages aren't modified.
+
+  Returns:
+    (own, fields, tree) tuple of str, the hash of all values except nested
+    fields, the hash of the nested fields and the hash of both.
+  """
+  cached = memo.get(id(message))
+  if cached is None:
+    values = [(f.number, message.get_assigned_value(f.name))
+              for f in message.all_fields() if f.name != 'fields']
+    own = hashlib.md5(repr(sorted(values))).digest()
+    children = sorted((f.name, _GetContentHashes(f, memo)[2])
+                      for f in message.fields)
+    fields = hashlib.md5(repr(children)).digest()
+    tree = hashlib.md5(own + fields).digest()
+    # Keep a reference to the message so that its id isn't reused.
+    cached = memo[id(message)] = (message, (own, fields, tree))
+  return cached[1]
+
+
+def MetadataDiff(kind, metadata1, metadata2, memo=None):
   """Finds and reports the difference between two metadata.
 
   Args:
     kind: string, the kind being updated.
     metadata1: metadata_messages.Metadata, metadata to be updated.
     metadata2: metadata_messages.Metadata, metadata to compare against.
+    memo: dict, content hashes of visited messages, see _GetContentHashes.
   Returns:
     errors: list of str, difference reported as list of errors.
   """
+  memo = {} if memo is None else memo
+  own1, fields1, tree1 = _GetContentHashes(metadata1, memo)
+  own2, fields2, tree2 = _GetContentHashes(metadata2, memo)
+  if tree1 == tree2:
+    return []
   errors = []
-  properties = metadata2.all_fields()
-  mismatch_properties = {
-      f.name for f in properties
-      if getattr(metadata1, f.name, None) != getattr(metadata2, f.name, None)}
-  if 'fields' in mismatch_properties:
-    mismatch_fields = GetMetadataFieldsDiff(
-        metadata1, metadata2)
-    mismatch_properties.remove('fields')
+  mismatch_properties = set()
+  if own1 != own2:
+    properties = metadata2.all_fields()
+    mismatch_properties = {
+        f.name for f in properties if f.name != 'fields' and
+        getattr(metadata1, f.name, None) != getattr(metadata2, f.name, None)}
+  if fields1 != fields2:
+    # Two metadatas can compare differently due to different orders of fields,
+    # which their hashes ignore.
+    mismatch_fields = GetMetadataFieldsDiff(metadata1, metadata2, memo)
     if mismatch_fields:
-      # Two metadatas can compare differently due to different orders of fields.
-      # This will be detected by GetMetadataFieldsDiff() which will return no
-      # differences in that case.
       errors.append(error_msg.OVERRIDE_FIELD % (kind, mismatch_fields))
   if mismatch_properties:
     if 'is_managed' in mismatch_properties:
@@ -406,11 +665,11 @@ def MetadataDiff(kind, metadata1, metadata2):
   return errors
 
 
-def GetMetadataFieldsDiff(metadata_one, metadata_two):
+def GetMetadataFieldsDiff(metadata_one, metadata_two, memo=None):
   """Returns field names that differ between two input metadata values."""
   diff_set = set()
   GetMetadataFieldsDiffSet(
-      diff_set, '', metadata_one.fields, metadata_two.fields)
+      diff_set, '', metadata_one.fields, metadata_two.fields, memo)
   return sorted(diff_set)
 
 
@@ -434,7 +693,8 @@ def MetadataDiffSet(diff_set, prefix, metadata_one, metadata_two):
           diff_set, prefix, metadata_one.fields, metadata_two.fields)
 
 
-def GetMetadataFieldsDiffSet(diff_set, prefix, fields_one, fields_two):
+def GetMetadataFieldsDiffSet(diff_set, prefix, fields_one, fields_two,
+                             memo=None):
   """Finds fields that are different between fields_one and fields_two.
 
   Args:
@@ -442,7 +702,9 @@ def GetMetadataFieldsDiffSet(diff_set, prefix, fields_one, fields_two):
     prefix: str, prefixes the names of different elements with this.
     fields_one: metadata_messages.MetadataFields, fields to compare.
     fields_two: metadata_messages.MetadataFields, fields to compare.
+    memo: dict, content hashes of visited messages, see _GetContentHashes.
   """
+  memo = {} if memo is None else memo
   fields1 = {f.name: f for f in fields_one}
   fields2 = {f.name: f for f in fields_two}
 
@@ -450,14 +712,22 @@ def GetMetadataFieldsDiffSet(diff_set, prefix, fields_one, fields_two):
     field1 = fields1.get(key)
     field2 = fields2.get(key)
     key = str(key)
-    if field1 and field2 and field1.fields and field2.fields:
-      GetMetadataFieldsDiffSet(
-          diff_set, prefix + key + '.', field1.fields, field2.fields)
-      field1 = copy.copy(field1)
-      field1.fields = []
-      field2 = copy.copy(field2)
-      field2.fields = []
-      # Fall through to compare the rest of the fields.
+    if field1 and field2:
+      own1, sub_fields1, tree1 = _GetContentHashes(field1, memo)
+      own2, sub_fields2, tree2 = _GetContentHashes(field2, memo)
+      if tree1 == tree2:
+        continue  # Identical subtrees.
+      if field1.fields and field2.fields:
+        if sub_fields1 != sub_fields2:
+          GetMetadataFieldsDiffSet(
+              diff_set, prefix + key + '.', field1.fields, field2.fields, memo)
+        if own1 == own2:
+          continue
+        field1 = copy.copy(field1)
+        field1.fields = []
+        field2 = copy.copy(field2)
+        field2.fields = []
+        # Fall through to compare the rest of the fields.
     if field1 != field2:
       diff_set.add(prefix + key)
 
@@ -478,11 +748,58 @@ def _GetPropertyAttrs(field):
       ('verbose_name', field.verbose_name),
       ('auto_add', field.auto_add),
       ('auto_update', field.auto_update),
+      ('compression_level', field.json_compression_level),
+      ('compression_threshold', field.json_compression_threshold),
   )
 
 
-#@memoize.Memoize(warn_on_error=False)
+def _ForgetStructModel(unused_sub_attrs, model):
+  """Unregisters an evicted structured sub-model class from NDB."""
+  kind = model._get_kind()  # pylint: disable=protected-access
+  kind_map = ndb.Model._kind_map  # pylint: disable=protected-access
+  if kind_map.get(kind) is model:
+    kind_map.pop(kind, None)
+
+
+# Interned field properties and structured sub-models, shared by all entities.
+# Both are bounded so neither memory nor ndb.Model._kind_map grows with the
+# number of entities processed.
+_FIELD_PROPERTIES = lru_cache.LruCache(_MAX_FIELD_PROPERTIES)
+_STRUCT_MODELS = lru_cache.LruCache(
+    _MAX_STRUCT_MODELS, on_evict=_ForgetStructModel)
+
+
 def _GetFieldPropertyCached(property_attrs):
+  """Returns the shared NDB Property instance for property attributes."""
+  prop = _FIELD_PROPERTIES.Get(property_attrs)
+  if prop is lru_cache.MISSING:
+    prop = _FIELD_PROPERTIES.SetDefault(
+        property_attrs, _CreateFieldProperty(property_attrs))
+  return prop
+
+
+def _GetStructModel(sub_attrs):
+  """Returns the shared sub-model class for structured property attributes."""
+  model = _STRUCT_MODELS.Get(sub_attrs)
+  if model is lru_cache.MISSING:
+    properties = {}
+    for attrs in sub_attrs:
+      sub_prop = _GetFieldPropertyCached(attrs)
+      # pylint: disable=protected-access
+      properties[sub_prop._code_name] = sub_prop
+      # pylint: enable=protected-access
+    # The name is derived from the structure so that re-creating an evicted
+    # model replaces its ndb.Model._kind_map entry instead of adding one.
+    name = '_%s__Model' % hashlib.md5(repr(sub_attrs)).hexdigest()
+    model = _STRUCT_MODELS.SetDefault(
+        sub_attrs, ndb.MetaModel(name, (ndb.Expando,), properties))
+    # A class created by a thread that lost the race registered itself under
+    # the same name, so point the kind map back at the cached class.
+    ndb.Model._kind_map[name] = model  # pylint: disable=protected-access
+  return model
+
+
+def _CreateFieldProperty(property_attrs):
   """Converts property attributes into an NDB Property instance."""
   # The "required" and "choices" attributes are always disabled to avoid NDB
   # validation errors on existing data. Metadata validation should already cover
@@ -492,21 +809,15 @@ def _GetFieldPropertyCached(property_attrs):
   sub_attrs = property_attrs.pop('sub_attrs')
   auto_add = property_attrs.pop('auto_add')
   auto_update = property_attrs.pop('auto_update')
+  compression_level = property_attrs.pop('compression_level')
+  compression_threshold = property_attrs.pop('compression_threshold')
   default = property_attrs.get('default')
   cls = metadata_messages.PROPERTY_MAP[property_type]
   if cls is not ndb.GenericProperty and not issubclass(cls, ndb.TextProperty):
     if default is not None:
       property_attrs['default'] = metadata_conversions.MaybeFromString(default)
   if issubclass(cls, (ndb.StructuredProperty, ndb.LocalStructuredProperty)):
-    properties = {}
-    for attrs in sub_attrs:
-      sub_prop = _GetFieldPropertyCached(attrs)
-      # pylint: disable=protected-access
-      properties[sub_prop._code_name] = sub_prop
-      # pylint: enable=protected-access
-    model = ndb.MetaModel(
-        '_%s__Model' % uuid.uuid4(), (ndb.Expando,), properties)
-    prop = cls(model, **property_attrs)
+    prop = cls(_GetStructModel(sub_attrs), **property_attrs)
   elif issubclass(cls, ndb.DateTimeProperty):
     prop = cls(auto_now_add=auto_add, auto_now=auto_update, **property_attrs)
   elif issubclass(cls, ndb.UserProperty):
@@ -514,6 +825,9 @@ def _GetFieldPropertyCached(property_attrs):
                **property_attrs)
   elif issubclass(cls, ndb.ComputedProperty):
     return None
+  elif issubclass(cls, model_utils.DHJsonProperty):
+    prop = cls(compression_level=compression_level,
+               compression_threshold=compression_threshold, **property_attrs)
   else:
     prop = cls(**property_attrs)
   prop._code_name = property_attrs['name']  # pylint: disable=protected-access
@@ -0,0 +1,60 @@
+"""Benchmarks entity population against the number of metadata fields.
+
+Populating an entity looks up the metadata field of every value it is given,
+so with a linear field lookup the time per field grows with the field count.
+With the field name index it should stay flat.
+
+Usage:
+
+  python -m _base.metadata.metadata_utils_benchmark
+"""
+
+from _base.metadata import metadata_messages
+from _base.metadata import metadata_models
+from _base.metadata import metadata_utils
+from _base.utils import benchmark_utils
+
+_FIELD_COUNTS = (10, 50, 200, 800)
+
+
+class BenchmarkModel(metadata_models.MetadataModel):
+  pass
+
+
+def _LinearGetFieldByName(metadata, name):
+  """The field lookup before the field name index."""
+  for field in metadata.fields:
+    if field.name == name:
+      return field
+
+
+def _CreateMetadata(field_count):
+  return metadata_messages.Metadata(
+      kind=BenchmarkModel._get_kind(),  # pylint: disable=protected-access
+      fields=[metadata_messages.MetadataField(
+          name='field%04d' % i,
+          property_type=metadata_messages.PropertyType.STRING)
+              for i in xrange(field_count)])
+
+
+def main():
+  rows = []
+  for field_count in _FIELD_COUNTS:
+    metadata = _CreateMetadata(field_count)
+    names = [field.name for field in metadata.fields]
+    values = {name: 'value' for name in names}
+    BenchmarkModel._meta = metadata  # pylint: disable=protected-access
+    populate = benchmark_utils.Time(lambda: BenchmarkModel(**values))
+    indexed = benchmark_utils.Time(
+        lambda: [metadata_utils.GetFieldByName(metadata, n) for n in names])
+    linear = benchmark_utils.Time(
+        lambda: [_LinearGetFieldByName(metadata, n) for n in names])
+    rows.append([field_count, populate, populate / field_count,
+                 indexed / field_count, linear / field_count])
+  benchmark_utils.PrintTable(
+      'Entity population (us)',
+      ['fields', 'entity', 'per field', 'lookup', 'linear lookup'], rows)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,226 @@
+"""Compiled validation and normalization of rows against metadata fields.
+
+A RowValidator is compiled once from metadata: regexes are compiled, choices
+are turned into frozensets and case conversions are resolved to functions, so
+validating a row is a single pass over the fields that have rules.
+
+Entities of kinds whose metadata sets validate_on_put are validated with it
+before they are put, see MetadataModel._validate_row(). Other kinds keep
+accepting stored data that predates their rules.
+
+Usage:
+
+  validator = metadata_api.GetRowValidatorCached(kind)
+  errors = validator(row)  # Normalizes row in place.
+  if errors:
+    ...
+"""
+
+import decimal
+import logging
+import re
+
+from _base.errors import error_collector
+from _base.errors import error_msg
+from _base.metadata import metadata_conversions
+from _base.metadata import metadata_messages
+from _base.utils import conversion_utils
+
+
+# Property types whose default values and choices are not JSON encoded.
+_STRING_TYPES = frozenset([
+    metadata_messages.PropertyType.GENERIC,
+    metadata_messages.PropertyType.STRING,
+    metadata_messages.PropertyType.TEXT,
+])
+
+_CASE_FUNCTIONS = {
+    metadata_messages.CaseType.LOWER: lambda value: value.lower(),
+    metadata_messages.CaseType.UPPER: lambda value: value.upper(),
+    metadata_messages.CaseType.TITLE: lambda value: value.title(),
+}
+
+_RANGE_MESSAGES = {
+    metadata_messages.PropertyType.CURRENCY: error_msg.DECIMAL_RANGE_FAIL,
+    metadata_messages.PropertyType.DECIMAL: error_msg.DECIMAL_RANGE_FAIL,
+    metadata_messages.PropertyType.FLOAT: error_msg.FLOAT_RANGE_FAIL,
+    metadata_messages.PropertyType.INTEGER: error_msg.INT_RANGE_FAIL,
+}
+
+_NUMERIC_TYPES = (int, long, float, decimal.Decimal)
+
+
+def _IsEmpty(value):
+  return value is None or value == '' or value == []
+
+
+def _CompileChoices(field):
+  """Returns the allowed values of a field as a frozenset, or None."""
+  if not field.choices:
+    return None
+  choices = set(field.choices)
+  if field.property_type not in _STRING_TYPES:
+    # Accept both the JSON encoded choices and their coerced values.
+    for choice in field.choices:
+      try:
+        choices.add(metadata_conversions.Convert(
+            metadata_conversions.MaybeFromString(choice), field.property_type))
+      except (conversion_utils.ConversionError, TypeError, ValueError):
+        pass
+  return frozenset(choices)
+
+
+def _CompileRegex(field):
+  """Returns the compiled regex of a field that values must fully match."""
+  if not field.regex:
+    return None
+  try:
+    return re.compile('(?:%s)\\Z' % field.regex)
+  except re.error as e:
+    logging.warning('Ignoring invalid regex %r of field %s: %s',
+                    field.regex, field.name, e)
+    return None
+
+
+class _FieldValidator(object):
+  """Compiled rules of a single metadata field."""
+
+  __slots__ = ('name', 'required', 'case', 'strip', 'regex', 'pattern',
+               'choices', 'range', 'range_msg', 'quantum', 'digits', 'unique')
+
+  def __init__(self, field):
+    """Initialization of a _FieldValidator.
+
+    Args:
+      field: metadata_messages.MetadataField, the field to compile.
+    """
+    self.name = field.name
+    self.required = field.required
+    self.case = _CASE_FUNCTIONS.get(field.convert_case)
+    self.strip = field.strip_whitespace
+    self.pattern = field.regex
+    self.regex = _CompileRegex(field)
+    self.choices = _CompileChoices(field)
+    self.range = tuple(field.range) if len(field.range) == 2 else None
+    self.range_msg = _RANGE_MESSAGES.get(
+        field.property_type, error_msg.FLOAT_RANGE_FAIL)
+    self.digits = field.decimal_digits
+    self.quantum = None
+    if self.digits is not None:
+      self.quantum = decimal.Decimal(1).scaleb(-self.digits)
+    self.unique = field.unique
+
+  def HasRules(self):
+    return bool(self.required or self.case or self.strip or self.regex or
+                self.choices is not None or self.range or
+                self.digits is not None or self.unique)
+
+  def Normalize(self, value):
+    """Returns a single value with whitespace, case and digits normalized."""
+    if isinstance(value, basestring):
+      if self.strip:
+        value = value.strip()
+      if self.case:
+        value = self.case(value)
+    elif self.digits is not None:
+      if isinstance(value, decimal.Decimal):
+        value = value.quantize(self.quantum, decimal.ROUND_HALF_UP)
+      elif isinstance(value, float):
+        value = round(value, self.digits)
+    return value
+
+  def Validate(self, value, errors):
+    """Validates a single normalized, non-empty value.
+
+    Args:
+      value: *, the value to validate.
+      errors: error_collector.Errors, collects the problems found.
+    """
+    if self.regex and isinstance(value, basestring):
+      if not self.regex.match(value):
+        errors.Add(self.name, error_msg.REGEX_FAIL % (self.name, self.pattern))
+    if self.choices is not None:
+      try:
+        allowed = value in self.choices
+      except TypeError:  # Unhashable values can't be choices.
+        allowed = False
+      if not allowed:
+        errors.Add(self.name, error_msg.CHOICE_LIST_FAIL % (value, self.name))
+    if self.range:
+      number = value
+      if not isinstance(number, _NUMERIC_TYPES):
+        number = conversion_utils.ToFloat(value, None)
+      if number is not None and not self.range[0] <= number <= self.range[1]:
+        errors.Add(self.name, self.range_msg % (value, list(self.range)))
+
+
+class RowValidator(object):
+  """Validates and normalizes rows (dicts) of a kind against its metadata."""
+
+  def __init__(self, metadata):
+    """Initialization of a RowValidator.
+
+    Args:
+      metadata: metadata_messages.Metadata, the metadata to compile.
+    """
+    self.kind = metadata.kind
+    validators = (_FieldValidator(field) for field in metadata.fields)
+    self._fields = tuple(v for v in validators if v.HasRules())
+    # The names of the fields that have rules.
+    self.field_names = tuple(field.name for field in self._fields)
+
+  def __call__(self, row, errors=None, seen=None):
+    """Validates and normalizes a row in place.
+
+    Args:
+      row: dict, field names and values. Values are normalized in place.
+      errors: error_collector.Errors, collects the problems found, a new
+          instance is used if omitted.
+      seen: dict, values of unique fields seen in other rows of the same batch
+          by field name. Updated with the values of this row.
+
+    Returns:
+      error_collector.Errors, the problems found, keyed by field name.
+    """
+    if errors is None:
+      errors = error_collector.Errors()
+    for field in self._fields:
+      value = row.get(field.name)
+      if isinstance(value, list):
+        value = [field.Normalize(v) for v in value]
+      else:
+        value = field.Normalize(value)
+      if field.name in row:
+        row[field.name] = value
+      if _IsEmpty(value):
+        if field.required and not errors.HasContexts(errors.Context(
+            errors.ContextOptions.IGNORE_MISSING_FIELD, field.name)):
+          errors.Add(field.name, error_msg.REQUIRED_FAIL % field.name)
+        continue
+      for v in value if isinstance(value, list) else [value]:
+        field.Validate(v, errors)
+      if field.unique and seen is not None:
+        key = tuple(value) if isinstance(value, list) else value
+        values = seen.setdefault(field.name, set())
+        try:
+          duplicate = key in values
+          values.add(key)
+        except TypeError:  # Unhashable values are not checked.
+          continue
+        if duplicate:
+          errors.Add(field.name,
+                     error_msg.DUPLICATE_VALUE % (self.kind, field.name, value))
+    return errors
+
+  def ValidateRows(self, rows):
+    """Validates and normalizes many rows, checking uniqueness across them.
+
+    Args:
+      rows: list of dicts, the rows to validate. Values are normalized in
+          place.
+
+    Returns:
+      list of error_collector.Errors, the problems found in each row.
+    """
+    seen = {}
+    return [self(row, seen=seen) for row in rows]
@@ -0,0 +1,47 @@
+"""Helpers for the *_benchmark.py scripts.
+
+Benchmarks are plain scripts that print a table of timings, e.g.:
+
+  python -m _base.metadata.metadata_utils_benchmark
+"""
+
+import timeit
+
+
+def Time(func, number=None, repeat=3):
+  """Returns the best time of a call to func, in seconds.
+
+  Args:
+    func: callable, the function to time. It's called without arguments.
+    number: int, the number of calls per measurement. Chosen so that a
+        measurement takes at least 0.2 seconds if omitted.
+    repeat: int, the number of measurements to take the best of.
+
+  Returns:
+    float, the time of a single call.
+  """
+  timer = timeit.Timer(func)
+  if number is None:
+    number = 1
+    while timer.timeit(number) < 0.2:
+      number *= 10
+  return min(timer.repeat(repeat, number)) / number
+
+
+def PrintTable(title, header, rows):
+  """Prints benchmark results as an aligned table.
+
+  Args:
+    title: str, the title of the table.
+    header: list<str>, the column names.
+    rows: list<list>, the rows. Floats are formatted as microseconds.
+  """
+  rows = [[('%.1f' % (cell * 1e6)) if isinstance(cell, float) else str(cell)
+           for cell in row] for row in rows]
+  widths = [max(len(str(cell)) for cell in column)
+            for column in zip(header, *rows)]
+  print(title)
+  for row in [header] + rows:
+    print('  '.join(
+        str(cell).rjust(width) for cell, width in zip(row, widths)))
+  print('')
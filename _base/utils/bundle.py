@@ -1,10 +1,34 @@
 """Tools to work with files in the distribution bundle."""
 
 
+import cPickle as pickle
+import hashlib
+import logging
 import os
+import struct
+import threading
 
 from _base.utils import constants
 
+try:
+  import mmap  # pylint: disable=g-import-not-at-top
+except ImportError:
+  mmap = None
+
+
+# Returned by LoadFromSnapshot() when a file must be parsed, since None is a
+# valid value.
+MISSING = object()
+
+# Metadata snapshot format: magic, index size, pickled index, pickled values.
+_SNAPSHOT_MAGIC = 'DHMS\x02'
+_SNAPSHOT_INDEX_SIZE = struct.Struct('>Q')
+
+_snapshot_lock = threading.Lock()
+_snapshot = None
+# Snapshot keys to whether the file still matches its snapshot entry.
+_current_entries = {}
+
 
 def OpenFile(filename):
   """Open filename.
@@ -19,10 +43,14 @@ def OpenFile(filename):
   Raises:
     IOError
   """
+  return open(_GetPath(filename))
+
+
+def _GetPath(filename):
+  """Returns the absolute path of a file in the bundle."""
   if os.path.isabs(filename):
-    return open(filename)
-  else:
-    return open(os.path.join(constants.SERVER_PATH, filename))
+    return filename
+  return os.path.join(constants.SERVER_PATH, filename)
 
 
 def ReadFile(filename):
@@ -49,6 +77,139 @@ def LocateMetadataYamlFiles():
         yield os.path.join(relative_path, f)
 
 
-def ListMetadataYamlFiles():
-  """Returns a list of the paths of all metadata YAML files in the bundle."""
-  return list(LocateMetadataYamlFiles())
+def _SnapshotPath():
+  return os.path.join(constants.SERVER_PATH, constants.METADATA_SNAPSHOT)
+
+
+def _SnapshotKey(filename):
+  """Returns the normalized path of a file relative to the server directory."""
+  if os.path.isabs(filename):
+    filename = os.path.relpath(filename, constants.SERVER_PATH)
+  return os.path.normpath(filename)
+
+
+def _ReadSnapshot():
+  """Reads the metadata snapshot, memory-mapped if possible.
+
+  Returns:
+    (index, data, data_offset) tuple, or None if there is no valid snapshot.
+  """
+  try:
+    with open(_SnapshotPath(), 'rb') as f:
+      data = None
+      if mmap is not None:
+        try:
+          data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+          pass
+      if data is None:
+        data = f.read()
+  except IOError:
+    return None
+  index_offset = len(_SNAPSHOT_MAGIC) + _SNAPSHOT_INDEX_SIZE.size
+  try:
+    if data[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+      raise ValueError('Unknown snapshot format')
+    index_size, = _SNAPSHOT_INDEX_SIZE.unpack(
+        data[len(_SNAPSHOT_MAGIC):index_offset])
+    index = pickle.loads(data[index_offset:index_offset + index_size])
+  except (ValueError, EOFError, struct.error, pickle.UnpicklingError) as e:
+    logging.warning('Ignoring invalid metadata snapshot: %s', e)
+    return None
+  return index, data, index_offset + index_size
+
+
+def _IsEntryCurrent(key, entry):
+  """Returns whether a file still matches its snapshot entry.
+
+  Each file is checked once per process, the first time it is loaded, and
+  trusted afterwards, since the bundle doesn't change while an instance runs.
+  Files are compared by size and modification time. The contents of a file
+  are only hashed if its size matches but its modification time doesn't,
+  e.g. because the bundle was copied, which costs a read but not a parse.
+
+  Args:
+    key: str, the snapshot key of the file.
+    entry: tuple, the snapshot index entry of the file.
+
+  Returns:
+    bool, whether the snapshot value of the file can be used.
+  """
+  current = _current_entries.get(key)
+  if current is None:
+    unused_offset, unused_length, digest, size, mtime = entry
+    try:
+      stat = os.stat(_GetPath(key))
+      current = stat.st_size == size and (
+          stat.st_mtime == mtime or
+          hashlib.sha1(ReadFile(key)).hexdigest() == digest)
+    except (IOError, OSError):
+      current = False
+    if not current:
+      logging.warning('Metadata snapshot is stale for: %s', key)
+    _current_entries[key] = current
+  return current
+
+
+def _GetSnapshot():
+  """Returns the lazily loaded snapshot, or an empty tuple."""
+  global _snapshot
+  if _snapshot is None:
+    with _snapshot_lock:
+      if _snapshot is None:
+        _snapshot = _ReadSnapshot() or ()
+  return _snapshot
+
+
+def LoadFromSnapshot(filename):
+  """Returns the precompiled contents of a YAML file in the bundle.
+
+  Args:
+    filename: string, the relative path to the file from the server directory or
+      the absolute path.
+
+  Returns:
+    The parsed contents of the file, or MISSING if the file is not in the
+    snapshot or has changed since the snapshot was compiled.
+  """
+  snapshot = _GetSnapshot()
+  if not snapshot:
+    return MISSING
+  index, data, data_offset = snapshot
+  key = _SnapshotKey(filename)
+  entry = index['entries'].get(key)
+  if entry is None or not _IsEntryCurrent(key, entry):
+    return MISSING
+  offset, length = entry[:2]
+  offset += data_offset
+  return pickle.loads(data[offset:offset + length])
+
+
+def WriteSnapshot(contents):
+  """Writes the metadata snapshot file.
+
+  Args:
+    contents: dict, file paths with (source string, parsed value) tuples.
+  """
+  global _snapshot
+  entries = {}
+  values = []
+  offset = 0
+  for filename, (source, value) in sorted(contents.iteritems()):
+    value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    stat = os.stat(_GetPath(filename))
+    entries[_SnapshotKey(filename)] = (
+        offset, len(value), hashlib.sha1(source).hexdigest(), stat.st_size,
+        stat.st_mtime)
+    values.append(value)
+    offset += len(value)
+  index = pickle.dumps({'entries': entries}, pickle.HIGHEST_PROTOCOL)
+  with open(_SnapshotPath(), 'wb') as f:
+    f.write(_SNAPSHOT_MAGIC)
+    f.write(_SNAPSHOT_INDEX_SIZE.pack(len(index)))
+    f.write(index)
+    for value in values:
+      f.write(value)
+  with _snapshot_lock:
+    _snapshot = None
+    _current_entries.clear()
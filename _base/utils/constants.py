@@ -70,6 +70,12 @@ BASE_MODULE = '_base'
 # Constants for metadata.
 METADATA_BACKUP = 'backup'
 METADATA_UPDATE_SEARCH = 'update_search'
+# Memcache key for the metadata generation counter. It is bumped whenever a
+# Metadata entity is written so instances can drop their cached metadata.
+METADATA_VERSION_MEMCACHE_KEY = 'MetadataVersion'
+# Memcache key and expiration (seconds) of the summaries of stored metadata.
+METADATA_CATALOG_MEMCACHE_KEY = 'MetadataKindCatalog'
+METADATA_CATALOG_TIMEOUT = 600
 
 # A list of modules to search for Models (relative to BASE_MODULE). The order
 # of the modules is not maintained, and every Model should have a unique name.
@@ -200,6 +206,8 @@ SERVER_PATH = SERVER_BASE_PATH
 RIBBON_FILENAME = 'ribbon.yaml'
 METADATA_FILE_END = '_metadata.yaml'
 METADATA_FILE_LIST = 'metadata_file_list.yaml'
+# Precompiled metadata YAML files, see yaml_utils.CompileMetadataSnapshot.
+METADATA_SNAPSHOT = 'metadata_snapshot.bin'
 UNMANAGED_FILE_LIST = 'training/data/unmanaged_file_list.yaml'
 
 # BigQuery query related settings.
@@ -804,6 +812,25 @@ LIST_DEFAULT_LIMIT = 250
 # Maximum number of results to display in list methods.
 LIST_MAX_LIMIT = 5000
 
+# Query result cache. Memcache key of the per-kind generation counters, default
+# expiration (seconds) of cached results, the maximum number of cached results
+# per instance and the size (bytes) of the largest result that is cached.
+QUERY_CACHE_MEMCACHE_KEY = 'QueryCacheGeneration:%s'
+QUERY_CACHE_DEFAULT_TTL = 60
+QUERY_CACHE_MAX_ENTRIES = 500
+QUERY_CACHE_MAX_ENTRY_BYTES = 256 * 1024
+
+# Default number of shards of materialized query counters.
+COUNTER_DEFAULT_SHARDS = 20
+
+# How long (seconds) instances use the current JSON compression dictionary of
+# a kind before checking for a newer one.
+JSON_DICTIONARY_TIMEOUT = 600
+# Whether large JSON values are written compressed with the dictionary of their
+# kind. Only enable once every deployed version can read them, since versions
+# without json_compression can't.
+JSON_DICTIONARY_WRITES_ENABLED = False
+
 # Maximum ndb.StringProperty size.
 MAX_NDB_STRING_BYTES = 1500
 
@@ -16,6 +16,7 @@ from google.net.proto import ProtocolBuffer
 
 
 from _base.utils import constants
+from _base.utils import lru_cache
 
 
 _DEFAULT = object()  # sentinel object to detect default.
@@ -27,6 +28,19 @@ _DATE_RE = re.compile('^%s$' % _DATE_PATTERN)
 _DATETIME_RE = re.compile('^%s[Tt ]%s$' % (_DATE_PATTERN, _TIME_PATTERN))
 _DECIMAL_PRECISION = decimal.Decimal('0.01')
 
+# Strict RFC 3339 shapes that are parsed without dateutil, see ToDateTime.
+_TIME_PARTS_PATTERN = r'(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?Z?'
+_DATE_PARTS_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+_TIME_PARTS_RE = re.compile('^%s$' % _TIME_PARTS_PATTERN)
+_DATETIME_PARTS_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})[T ]%s$' % _TIME_PARTS_PATTERN)
+_TIMESTAMP_PARTS_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})$')
+
+# Parsed datetimes by string, imported columns tend to repeat values.
+_PARSED_DATETIMES = lru_cache.LruCache(1024)
+_INVALID = object()  # Cached for strings that can't be parsed.
+
 
 class ConversionError(Exception):
   """Error converting types."""
@@ -101,8 +115,78 @@ def DateObjToStr(obj):
 
 def DateStrToTimeStamp(datestr):
   """Converts an RFC3339 string to corresponding Unix timestamp value."""
-  return calendar.timegm(
-      datetime.datetime.strptime(datestr, '%Y-%m-%dT%H:%M:%S').utctimetuple())
+  dt = None
+  match = _TIMESTAMP_PARTS_RE.match(datestr)
+  if match:
+    try:
+      dt = datetime.datetime(*[int(part) for part in match.groups()])
+    except ValueError:
+      pass  # Out of range parts, let strptime report them.
+  if dt is None:
+    dt = datetime.datetime.strptime(datestr, '%Y-%m-%dT%H:%M:%S')
+  return calendar.timegm(dt.utctimetuple())
+
+
+def _ParseRfc3339(s):
+  """Parses strict RFC 3339 date, time and datetime strings (no offset).
+
+  Times are returned relative to the UTC epoch, like dateutil with _EPOCH as
+  default.
+
+  Args:
+    s: str, the string to parse.
+
+  Returns:
+    datetime.datetime, or None if s has a different shape.
+
+  Raises:
+    ValueError: if a date or time part is out of range.
+  """
+  match = _DATETIME_PARTS_RE.match(s)
+  if match:
+    year, month, day, hour, minute, second, fraction = match.groups()
+  else:
+    match = _DATE_PARTS_RE.match(s)
+    if match:
+      year, month, day = match.groups()
+      return datetime.datetime(int(year), int(month), int(day))
+    match = _TIME_PARTS_RE.match(s)
+    if not match:
+      return None
+    year, month, day = _EPOCH.year, _EPOCH.month, _EPOCH.day
+    hour, minute, second, fraction = match.groups()
+  microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+  return datetime.datetime(int(year), int(month), int(day), int(hour),
+                           int(minute), int(second), microsecond)
+
+
+def _ParseDateTimeStr(s):
+  """Parses a datetime string, memoizing the result.
+
+  Args:
+    s: str, the string to parse.
+
+  Returns:
+    datetime.datetime, the parsed value.
+
+  Raises:
+    ValueError: if s can't be parsed.
+  """
+  result = _PARSED_DATETIMES.Get(s)
+  if result is lru_cache.MISSING:
+    try:
+      result = _ParseRfc3339(s)
+    except ValueError:
+      result = None  # Out of range parts, dateutil decides as it always has.
+    try:
+      if result is None:
+        result = dateutil.parser.parse(s, ignoretz=True, default=_EPOCH)
+    except ValueError:
+      result = _INVALID
+    _PARSED_DATETIMES.Set(s, result)
+  if result is _INVALID:
+    raise ValueError('Cannot parse %r' % s)
+  return result
 
 
 def NoOp(*types):
@@ -368,7 +452,7 @@ def ToDateTime(value, default=_DEFAULT):
     elif not str(value):
       # dateutil parses empty strings as current datetime which we don't want.
       raise ValueError
-    return dateutil.parser.parse(str(value), ignoretz=True, default=_EPOCH)
+    return _ParseDateTimeStr(str(value))
   except ValueError:
     if default is _DEFAULT:
       raise ConversionError('Cannot convert %r to datetime' % value)
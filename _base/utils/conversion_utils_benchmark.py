@@ -0,0 +1,71 @@
+"""Benchmarks parsing dates and times from strings.
+
+Compares ToDate, ToTime, ToDateTime and DateStrToTimeStamp with the dateutil
+and strptime calls they used before the strict RFC 3339 fast path, for columns
+of distinct values (every value misses the memo) and of repeated values.
+
+Usage:
+
+  python -m _base.utils.conversion_utils_benchmark
+"""
+
+import calendar
+import datetime
+
+import dateutil.parser
+
+from _base.utils import benchmark_utils
+from _base.utils import conversion_utils
+
+_EPOCH = datetime.datetime.utcfromtimestamp(0)
+# More distinct values than the memo holds, so every parse misses it.
+_DISTINCT = 5000
+_REPEATED = 20
+
+
+def _OldToDateTime(value):
+  return dateutil.parser.parse(str(value), ignoretz=True, default=_EPOCH)
+
+
+def _OldDateStrToTimeStamp(datestr):
+  return calendar.timegm(datetime.datetime.strptime(
+      datestr, '%Y-%m-%dT%H:%M:%S').utctimetuple())
+
+
+def _CreateColumn(distinct, fmt):
+  start = datetime.datetime(2000, 1, 1)
+  step = datetime.timedelta(days=1, seconds=3607, microseconds=17)
+  values = [(start + i * step).strftime(fmt) for i in xrange(distinct)]
+  return [values[i % distinct] for i in xrange(_DISTINCT)]
+
+
+_CASES = (
+    ('ToDate', '%Y-%m-%d', conversion_utils.ToDate,
+     lambda v: _OldToDateTime(v).date()),
+    ('ToTime', '%H:%M:%S.%fZ', conversion_utils.ToTime,
+     lambda v: _OldToDateTime(v).time()),
+    ('ToDateTime', '%Y-%m-%dT%H:%M:%SZ', conversion_utils.ToDateTime,
+     _OldToDateTime),
+    ('ToDateTime free-form', '%d %B %Y %I:%M %p', conversion_utils.ToDateTime,
+     _OldToDateTime),
+    ('DateStrToTimeStamp', '%Y-%m-%dT%H:%M:%S',
+     conversion_utils.DateStrToTimeStamp, _OldDateStrToTimeStamp),
+)
+
+
+def main():
+  rows = []
+  for name, fmt, new, old in _CASES:
+    for label, distinct in (('distinct', _DISTINCT), ('repeated', _REPEATED)):
+      column = _CreateColumn(distinct, fmt)
+      before = benchmark_utils.Time(lambda: [old(v) for v in column], number=3)
+      after = benchmark_utils.Time(lambda: [new(v) for v in column], number=3)
+      rows.append([name, label, before / len(column), after / len(column),
+                   '%.1fx' % (before / after)])
+  benchmark_utils.PrintTable(
+      'Parsing %d values (us per value)' % _DISTINCT,
+      ['function', 'values', 'before', 'after', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,382 @@
+"""Materialized counts of entities matching equality filters.
+
+A counter is declared for a kind and a combination of equality filters, and is
+kept as sharded CounterShard entities. Whether an entity is counted is recorded
+by a CounterMarker entity, so a write only changes the count when it changes
+whether the entity matches. Counters are maintained from the MODEL_POST_PUT and
+MODEL_POST_DELETE signals, so only kinds of models that use signals.SignalMixin
+can be counted.
+
+Each counter is updated in its own cross-group transaction, which reads the
+entity and its marker and updates the marker and a shard. Writes made in a
+transaction update the counters once they are committed. Updates that are not
+waited for by the write, such as the ones of deletes, are waited for at the end
+of the request, by WaitForPendingUpdates, or by model_utils.CountAsync before
+it reads a counter of the kind.
+
+Filter values must be of types the datastore compares exactly: strings,
+booleans, integers, floats, None, dates and times, keys and protorpc enums.
+model_utils.CountAsync answers from a counter when its filters are exactly the
+filters of a declared counter, with values of the same types.
+
+Counters only see writes made after they are declared. Use RebuildCounterAsync
+to initialize a counter and its markers from the existing entities.
+
+Usage:
+
+  counter_models.RegisterCounter('MyModel', {'status': 'ACTIVE'})
+  count = model_utils.Count(MyModel, filters={'status': 'ACTIVE'})
+"""
+
+import datetime
+import hashlib
+import logging
+import random
+import threading
+
+from protorpc import messages
+
+from google.appengine.ext import ndb
+
+from _base.utils import constants
+from _base.utils import json_utils
+from _base.utils import request_state
+from _base.utils import signals
+
+
+_PENDING_STATE = 'counter_updates'
+
+_lock = threading.Lock()
+# Mapping of kinds to dicts of normalized filters to counters.
+_counters = {}
+
+
+class CounterShard(ndb.Model):
+  """A shard of a materialized counter.
+
+  Attributes:
+    count: int, the part of the count kept by this shard.
+  """
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class CounterMarker(ndb.Model):
+  """Records that an entity is counted by a counter.
+
+  Attributes:
+    counter_id: str, the id of the counter.
+  """
+  counter_id = ndb.StringProperty()
+
+
+class _Counter(object):
+  """A declared counter of a kind."""
+
+  def __init__(self, kind, filters, normalized, shards):
+    """Initialization of a _Counter.
+
+    Args:
+      kind: str, the model kind.
+      filters: dict, property names and the values they must be equal to.
+      normalized: str, the filters as returned by _NormalizeFilters.
+      shards: int, the number of shards.
+    """
+    self.kind = kind
+    self.filters = dict(filters)
+    self.shards = shards
+    self.counter_id = '%s:%s' % (kind, hashlib.sha1(normalized).hexdigest())
+    self._filter_keys = dict(
+        (name, _GetValueKey(value)) for name, value in filters.iteritems())
+
+  def ShardKeys(self):
+    return [ndb.Key(CounterShard, '%s:%d' % (self.counter_id, i))
+            for i in xrange(self.shards)]
+
+  def MarkerKey(self, key):
+    """Returns the key of the marker of an entity counted by this counter."""
+    return ndb.Key(CounterMarker, '%s:%s' % (
+        self.counter_id, hashlib.sha1(key.urlsafe()).hexdigest()))
+
+  def Matches(self, entity):
+    """Returns whether an entity is counted by this counter."""
+    if entity is None:
+      return False
+    for name, filter_key in self._filter_keys.iteritems():
+      prop = entity._properties.get(name)  # pylint: disable=protected-access
+      if prop is None:
+        return False
+      actual = prop._get_value(entity)  # pylint: disable=protected-access
+      if not isinstance(actual, list):
+        actual = [actual]
+      try:
+        if filter_key not in [_GetValueKey(value) for value in actual]:
+          return False
+      except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _GetValueKey(value):
+  """Returns a JSON serializable value that is equal only for equal values.
+
+  Values of different types are never equal, as in the datastore.
+
+  Args:
+    value: *, a filter or property value.
+
+  Returns:
+    list, the type and the value.
+
+  Raises:
+    TypeError: if the datastore can't compare values of this type exactly.
+    ValueError: if value is a byte string that isn't UTF-8.
+  """
+  if value is None:
+    return ['null', None]
+  if isinstance(value, bool):
+    return ['bool', value]
+  if isinstance(value, (int, long)):
+    return ['int', value]
+  if isinstance(value, float):
+    return ['float', repr(value)]
+  if isinstance(value, basestring):
+    if isinstance(value, str):
+      value = value.decode('utf-8')
+    return ['str', value]
+  if isinstance(value, (datetime.date, datetime.time)):
+    return [type(value).__name__, value.isoformat()]
+  if isinstance(value, ndb.Key):
+    return ['key', value.urlsafe()]
+  if isinstance(value, messages.Enum):
+    return ['enum', type(value).definition_name(), value.name]
+  raise TypeError('%r can\'t be compared exactly' % type(value))
+
+
+def _UnwrapFilters(filters):
+  """Returns equality filters with single values, or None.
+
+  Args:
+    filters: dict, Filter keys and their value.
+
+  Returns:
+    dict, the filters, or None if they are not all equality filters.
+  """
+  unwrapped = {}
+  for key, value in (filters or {}).iteritems():
+    if isinstance(value, (list, set, tuple)):
+      if len(value) != 1:
+        return None
+      value = list(value)[0]
+    unwrapped[key] = value
+  return unwrapped
+
+
+def _NormalizeFilters(filters):
+  """Returns a canonical string of equality filters, or None.
+
+  Args:
+    filters: dict, equality filters as returned by _UnwrapFilters.
+
+  Returns:
+    str, the JSON encoded filters with their value types, or None if they have
+    values of types that can't be compared exactly.
+  """
+  try:
+    return json_utils.Dump(dict(
+        (key, _GetValueKey(value)) for key, value in filters.iteritems()))
+  except (TypeError, ValueError):
+    return None
+
+
+def RegisterCounter(kind, filters=None,
+                    shards=constants.COUNTER_DEFAULT_SHARDS):
+  """Declares a counter of the entities of a kind matching equality filters.
+
+  Args:
+    kind: str, the model kind.
+    filters: dict, property names and the values they must be equal to. All
+        entities of the kind are counted if omitted.
+    shards: int, the number of shards. More shards allow more concurrent
+        writes, but make counting slower.
+
+  Raises:
+    ValueError: if filters are not equality filters of values that can be
+        compared exactly.
+  """
+  unwrapped = _UnwrapFilters(filters)
+  normalized = unwrapped is not None and _NormalizeFilters(unwrapped)
+  if not normalized:
+    raise ValueError('Counters require equality filters of strings, numbers, '
+                     'dates, keys or enums: %r' % filters)
+  counter = _Counter(kind, unwrapped, normalized, shards)
+  with _lock:
+    _counters.setdefault(kind, {})[normalized] = counter
+  signals.MODEL_POST_PUT.connect(_OnPostPut, sender=kind, weak=False)
+  signals.MODEL_POST_DELETE.connect(_OnPostDelete, sender=kind, weak=False)
+
+
+def GetCounter(kind, filters=None):
+  """Returns the counter declared for exactly these filters, or None."""
+  counters = _counters.get(kind)
+  if not counters:
+    return None
+  unwrapped = _UnwrapFilters(filters)
+  if unwrapped is None:
+    return None
+  return counters.get(_NormalizeFilters(unwrapped))
+
+
+@ndb.tasklet
+def GetCountAsync(counter):
+  """Returns the current value of a counter.
+
+  Args:
+    counter: _Counter, a counter returned by GetCounter().
+
+  Yields:
+    int, the number of entities counted.
+  """
+  shards = yield ndb.get_multi_async(counter.ShardKeys())
+  raise ndb.Return(sum(shard.count for shard in shards if shard))
+
+
+@ndb.tasklet
+def RebuildCounterAsync(model, filters=None):
+  """Recounts the entities of a declared counter with a query.
+
+  Writes made while the query runs may be lost, so this should be run when the
+  kind is not being written to.
+
+  Args:
+    model: class, the counted model.
+    filters: dict, the filters of the counter.
+
+  Yields:
+    int, the number of entities counted.
+
+  Raises:
+    KeyError: if no counter is declared for the model and filters.
+  """
+  kind = model._get_kind()  # pylint: disable=protected-access
+  counter = GetCounter(kind, filters)
+  if counter is None:
+    raise KeyError('No counter for %s with %r' % (model, filters))
+  query = model.query()
+  for name, value in counter.filters.iteritems():
+    prop = model._properties.get(name)  # pylint: disable=protected-access
+    if prop is None:
+      query = query.filter(ndb.FilterNode(name, '=', value))
+    else:
+      query = query.filter(prop == value)
+  keys, old_markers = yield (
+      query.fetch_async(keys_only=True),
+      CounterMarker.query(CounterMarker.counter_id == counter.counter_id)
+      .fetch_async(keys_only=True))
+  yield ndb.delete_multi_async(old_markers)
+  markers = [CounterMarker(key=counter.MarkerKey(key),
+                           counter_id=counter.counter_id) for key in keys]
+  shards = [CounterShard(key=key, count=0) for key in counter.ShardKeys()]
+  shards[0].count = len(keys)
+  yield ndb.put_multi_async(markers + shards)
+  raise ndb.Return(len(keys))
+
+
+def _UpdateMembershipAsync(counter, key):
+  """Updates the marker of an entity and the count if its match changed.
+
+  Args:
+    counter: _Counter, the counter to update.
+    key: ndb.Key, the key of the written entity.
+
+  Returns:
+    Future, resolved once the update is committed.
+  """
+  marker_key = counter.MarkerKey(key)
+
+  @ndb.tasklet
+  def _Txn():
+    entity, marker = yield ndb.get_multi_async(
+        [key, marker_key], use_cache=False, use_memcache=False)
+    matches = counter.Matches(entity)
+    if matches == (marker is not None):
+      return
+    shard_key = counter.ShardKeys()[random.randrange(counter.shards)]
+    shard = yield shard_key.get_async(use_cache=False, use_memcache=False)
+    if shard is None:
+      shard = CounterShard(key=shard_key)
+    if matches:
+      shard.count += 1
+      yield ndb.put_multi_async([shard, CounterMarker(
+          key=marker_key, counter_id=counter.counter_id)])
+    else:
+      shard.count -= 1
+      yield shard.put_async(), marker_key.delete_async()
+
+  return ndb.transaction_async(
+      _Txn, xg=True, propagation=ndb.TransactionOptions.INDEPENDENT)
+
+
+@ndb.tasklet
+def _UpdateCountersAsync(kind, key):
+  yield [_UpdateMembershipAsync(counter, key)
+         for counter in _counters.get(kind, {}).values()]
+
+
+def _StartUpdates(kind, key):
+  """Starts updating the counters of a written entity without waiting."""
+  future = _UpdateCountersAsync(kind, key)
+  request_state.GetRequestState(_PENDING_STATE)[id(future)] = (kind, future)
+
+
+@ndb.tasklet
+def WaitForPendingUpdatesAsync(kind=None):
+  """Waits for the counter updates started without waiting in this request.
+
+  Args:
+    kind: str, only wait for the updates of the counters of this kind. All
+        pending updates are waited for if omitted.
+
+  Raises:
+    Exception: the error of the first update that failed, if any.
+  """
+  pending = request_state.GetRequestState(_PENDING_STATE)
+  futures = []
+  for future_id, (future_kind, future) in pending.items():
+    if kind is None or future_kind == kind:
+      del pending[future_id]
+      futures.append(future)
+  errors = []
+  for future in futures:
+    try:
+      yield future
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+  if errors:
+    raise errors[0]
+
+
+def WaitForPendingUpdates(kind=None):
+  WaitForPendingUpdatesAsync(kind=kind).get_result()
+
+
+@signals.REQUEST_END.connect
+def _OnRequestEnd(unused_sender):
+  try:
+    WaitForPendingUpdates()
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('Failed to update counters.')
+
+
+@ndb.tasklet
+def _OnPostPut(sender, entity=None, **unused_kwargs):
+  """Updates the counters of a put entity once the put is committed."""
+  if ndb.in_transaction():
+    key = entity.key
+    ndb.get_context().call_on_commit(lambda: _StartUpdates(sender, key))
+  else:
+    yield _UpdateCountersAsync(sender, entity.key)
+
+
+def _OnPostDelete(sender, key=None, **unused_kwargs):
+  """Updates the counters of a deleted entity once the delete is committed."""
+  ndb.get_context().call_on_commit(lambda: _StartUpdates(sender, key))
@@ -0,0 +1,151 @@
+"""Tests for counter_models."""
+
+import datetime
+import unittest
+
+from protorpc import messages
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from google.appengine.ext.ndb import msgprop
+
+from _base.utils import counter_models
+from _base.utils import model_utils
+from _base.utils import signals
+
+
+class Color(messages.Enum):
+  RED = 1
+  BLUE = 2
+
+
+class CountedModel(signals.SignalMixin, ndb.Model):
+  status = ndb.StringProperty()
+  day = ndb.DateProperty()
+  owner = ndb.KeyProperty()
+  color = msgprop.EnumProperty(Color)
+  flag = ndb.BooleanProperty()
+  number = ndb.IntegerProperty()
+
+
+class CounterModelsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.kind = CountedModel._get_kind()  # pylint: disable=protected-access
+
+  def tearDown(self):
+    counter_models._counters.clear()  # pylint: disable=protected-access
+    self.testbed.deactivate()
+
+  def _Count(self, filters):
+    counter_models.WaitForPendingUpdates()
+    counter = counter_models.GetCounter(self.kind, filters)
+    self.assertIsNotNone(counter)
+    return counter_models.GetCountAsync(counter).get_result()
+
+  def testPut(self):
+    counter_models.RegisterCounter(self.kind, {'status': 'ACTIVE'})
+    entity = CountedModel(status='ACTIVE')
+    entity.put()
+    CountedModel(status='RETIRED').put()
+    self.assertEqual(1, self._Count({'status': 'ACTIVE'}))
+
+    # Writing the entity again doesn't count it twice.
+    entity.put()
+    self.assertEqual(1, self._Count({'status': 'ACTIVE'}))
+
+    entity.status = 'RETIRED'
+    entity.put()
+    self.assertEqual(0, self._Count({'status': 'ACTIVE'}))
+
+  def testDelete(self):
+    counter_models.RegisterCounter(self.kind, {'status': 'ACTIVE'})
+    key = CountedModel(status='ACTIVE').put()
+    other = CountedModel(status='RETIRED').put()
+    self.assertEqual(1, self._Count({'status': 'ACTIVE'}))
+
+    other.delete()
+    self.assertEqual(1, self._Count({'status': 'ACTIVE'}))
+    key.delete()
+    self.assertEqual(0, self._Count({'status': 'ACTIVE'}))
+
+    # Deleting it again doesn't make the count negative.
+    key.delete()
+    self.assertEqual(0, self._Count({'status': 'ACTIVE'}))
+
+  def testTransactionalPut(self):
+    counter_models.RegisterCounter(self.kind, {'status': 'ACTIVE'})
+
+    key = ndb.transaction(CountedModel(status='ACTIVE').put)
+    self.assertEqual(1, self._Count({'status': 'ACTIVE'}))
+
+    @ndb.transactional
+    def _RolledBack():
+      CountedModel(status='ACTIVE').put()
+      raise ndb.Rollback()
+
+    _RolledBack()
+    self.assertEqual(1, self._Count({'status': 'ACTIVE'}))
+
+    ndb.transaction(key.delete)
+    self.assertEqual(0, self._Count({'status': 'ACTIVE'}))
+
+  def testCountWaitsForPendingUpdates(self):
+    counter_models.RegisterCounter(self.kind, {'status': 'ACTIVE'})
+    key = CountedModel(status='ACTIVE').put()
+    other = ndb.transaction(CountedModel(status='ACTIVE').put)
+    self.assertEqual(2, model_utils.Count(
+        CountedModel, filters={'status': 'ACTIVE'}))
+
+    key.delete()
+    ndb.transaction(other.delete)
+    self.assertEqual(0, model_utils.Count(
+        CountedModel, filters={'status': 'ACTIVE'}))
+
+  def testDateKeyAndEnumFilters(self):
+    day = datetime.date(2020, 6, 1)
+    owner = ndb.Key('Owner', 'owner-1')
+    filters = {'day': day, 'owner': owner, 'color': Color.RED}
+    counter_models.RegisterCounter(self.kind, filters)
+    CountedModel(day=day, owner=owner, color=Color.RED).put()
+    CountedModel(day=day, owner=owner, color=Color.BLUE).put()
+    CountedModel(day=day, owner=ndb.Key('Owner', 'owner-2'),
+                 color=Color.RED).put()
+    self.assertEqual(1, self._Count(filters))
+    self.assertEqual(1, self._Count(
+        {'day': [day], 'owner': owner, 'color': Color.RED}))
+
+  def testFilterValuesKeepTheirType(self):
+    counter_models.RegisterCounter(self.kind, {'flag': True})
+    counter = counter_models.GetCounter(self.kind, {'flag': True})
+    self.assertIs(True, counter.filters['flag'])
+    self.assertIsNone(counter_models.GetCounter(self.kind, {'flag': 1}))
+
+    CountedModel(flag=True).put()
+    CountedModel(number=1).put()
+    self.assertEqual(1, self._Count({'flag': True}))
+
+  def testRegisterRejectsInexactFilters(self):
+    self.assertRaises(ValueError, counter_models.RegisterCounter, self.kind,
+                      {'status': ['ACTIVE', 'RETIRED']})
+    self.assertRaises(ValueError, counter_models.RegisterCounter, self.kind,
+                      {'status': object()})
+
+  def testRebuildCounter(self):
+    keys = [CountedModel(status='ACTIVE').put() for _ in xrange(3)]
+    counter_models.RegisterCounter(self.kind, {'status': 'ACTIVE'})
+    count = counter_models.RebuildCounterAsync(
+        CountedModel, {'status': 'ACTIVE'}).get_result()
+    self.assertEqual(3, count)
+
+    keys[0].delete()
+    self.assertEqual(2, self._Count({'status': 'ACTIVE'}))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,420 @@
+"""Preset dictionary compression of large JSON property values.
+
+zlib compresses small, repetitive values poorly because each value starts with
+an empty window. A preset dictionary of the substrings common to the values of
+a kind fills the window first, so these substrings compress to back references
+from the first byte on.
+
+The zlib module of Python 2.7 has no preset dictionary support, so it is
+emulated: a raw deflate stream is primed with the dictionary and flushed once,
+and each value is compressed with a copy of the primed compressor. Values are
+decompressed with a copy of a decompressor primed with the same bytes.
+
+Dictionaries are trained per kind from sample values and stored as versioned
+JsonDictionary entities. Values are compressed with the latest version of their
+kind's dictionary and name the dictionary they were compressed with, so they
+remain readable after newer versions are trained.
+
+Dictionaries are loaded on instance warmup and reloaded in the background when
+they expire, so writes never wait for them. Values are compressed with plain
+zlib until the dictionary of their kind is loaded. Reading a value compressed
+with a dictionary that isn't loaded loads it once.
+
+Values are only written with dictionaries if JSON_DICTIONARY_WRITES_ENABLED is
+set, which must wait until every deployed version can read them.
+
+Usage:
+
+  json_compression.TrainAndSaveDictionary('Device', samples)
+  stats = json_compression.GetStats()
+"""
+
+import collections
+import hashlib
+import logging
+import re
+import threading
+import time
+import zlib
+
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import model as ndb_model
+
+from _base.utils import constants
+from _base.utils import lru_cache
+from _base.utils import signals
+
+
+# Stored payloads are the prefix, the dictionary id and a raw deflate stream.
+# The prefix starts with a byte that JSON and zlib streams never start with.
+_PAYLOAD_PREFIX = '\x00dz'
+_DICTIONARY_ID_BYTES = 8
+
+# Dictionary bytes further away than the deflate window can't be referenced.
+_MAX_DICTIONARY_BYTES = 32 * 1024
+# Only the beginning of each sample is used for training.
+_MAX_SAMPLE_BYTES = 64 * 1024
+# Lengths, in JSON tokens, of the sample substrings considered for training.
+_TRAINING_NGRAMS = (1, 2, 3, 4, 6, 8)
+# Splits JSON into strings (with their colon, if keys), punctuation and
+# literals.
+_JSON_TOKEN_RE = re.compile(
+    r'"(?:[^"\\]|\\.)*"\s*:?|[\[\]{},]|[^\s"\[\]{},:]+')
+
+_MAX_CODECS = 64
+
+_lock = threading.Lock()
+# Kinds to (expiration time, JsonDictionary or None) tuples.
+_current = {}
+# Kinds to (start time, Future) tuples of the loads refreshing _current.
+_refreshes = {}
+# Dictionary ids to dictionary data, or None if there is no such dictionary.
+_data = {}
+# Primed compressors by (dictionary id, level) and decompressors by id.
+_compressors = lru_cache.LruCache(_MAX_CODECS)
+_decompressors = lru_cache.LruCache(_MAX_CODECS)
+_stats = collections.defaultdict(collections.Counter)
+
+
+class JsonDictionary(ndb.Model):
+  """A version of the JSON compression dictionary of a kind.
+
+  The key id is the hex encoded dictionary id, which is derived from the data.
+
+  Attributes:
+    model_kind: str, the kind the dictionary was trained for.
+    version: int, the version of the dictionary for the kind.
+    data: str, the dictionary.
+    created: datetime, when the dictionary was trained.
+    sample_count: int, the number of sample values it was trained with.
+    sample_bytes: int, the size of the sample values.
+    zlib_bytes: int, the size of the sample values compressed without the
+        dictionary.
+    dictionary_bytes: int, the size of the sample values compressed with the
+        dictionary.
+  """
+  model_kind = ndb.StringProperty(required=True)
+  version = ndb.IntegerProperty(required=True)
+  data = ndb.BlobProperty(required=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  sample_count = ndb.IntegerProperty(indexed=False)
+  sample_bytes = ndb.IntegerProperty(indexed=False)
+  zlib_bytes = ndb.IntegerProperty(indexed=False)
+  dictionary_bytes = ndb.IntegerProperty(indexed=False)
+
+
+class DictCompressedValue(object):
+  """A stored JSON value compressed with a preset dictionary."""
+
+  __slots__ = ('payload',)
+
+  def __init__(self, payload):
+    self.payload = payload
+
+  def __eq__(self, other):
+    if not isinstance(other, DictCompressedValue):
+      return NotImplemented
+    return self.payload == other.payload
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  def __repr__(self):
+    return 'DictCompressedValue(%r)' % self.payload
+
+
+def IsPayload(data):
+  """Returns whether a stored string is a dictionary compressed value."""
+  return data[:len(_PAYLOAD_PREFIX)] == _PAYLOAD_PREFIX
+
+
+def _GetDictionaryId(data):
+  return hashlib.sha1(data).digest()[:_DICTIONARY_ID_BYTES]
+
+
+def _Prime(data, level):
+  """Returns a compressor primed with a dictionary and the bytes it output."""
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  primed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+  return compressor, primed
+
+
+def _CompressWith(compressor, data):
+  compressor = compressor.copy()
+  return compressor.compress(data) + compressor.flush()
+
+
+def _GetCompressor(dictionary_id, data, level):
+  key = (dictionary_id, level)
+  compressor = _compressors.Get(key)
+  if compressor is lru_cache.MISSING:
+    compressor = _compressors.SetDefault(key, _Prime(data, level)[0])
+  return compressor
+
+
+@ndb.non_transactional
+def _LoadDictionary(dictionary_id):
+  return ndb.Key(JsonDictionary, dictionary_id.encode('hex')).get()
+
+
+@ndb.non_transactional
+def _LoadDictionariesAsync(kind=None):
+  query = JsonDictionary.query()
+  if kind is not None:
+    query = query.filter(JsonDictionary.model_kind == kind)
+  return query.fetch_async()
+
+
+def _SetDictionaries(dictionaries, kinds=()):
+  """Caches loaded dictionaries and the latest dictionary of their kinds.
+
+  Args:
+    dictionaries: list<JsonDictionary>, the loaded dictionaries.
+    kinds: list<str>, kinds whose dictionaries were loaded, including the ones
+        that have none.
+  """
+  latest = dict.fromkeys(kinds)
+  for dictionary in dictionaries:
+    current = latest.get(dictionary.model_kind)
+    if current is None or dictionary.version > current.version:
+      latest[dictionary.model_kind] = dictionary
+  expires = time.time() + constants.JSON_DICTIONARY_TIMEOUT
+  with _lock:
+    for dictionary in dictionaries:
+      _data[_GetDictionaryId(dictionary.data)] = dictionary.data
+    for kind, dictionary in latest.iteritems():
+      _current[kind] = (expires, dictionary)
+
+
+def _RefreshAsync(kind):
+  """Starts reloading the dictionaries of a kind unless it is in progress."""
+  now = time.time()
+  with _lock:
+    started, future = _refreshes.get(kind, (0, None))
+    if future is not None and started + constants.JSON_DICTIONARY_TIMEOUT > now:
+      return
+    future = _LoadDictionariesAsync(kind)
+    _refreshes[kind] = (now, future)
+  future.add_callback(_OnRefreshed, kind, future)
+
+
+def _OnRefreshed(kind, future):
+  with _lock:
+    _refreshes.pop(kind, None)
+  if future.get_exception():
+    logging.warning('Failed to load the JSON dictionaries of %s: %s', kind,
+                    future.get_exception())
+  else:
+    _SetDictionaries(future.get_result(), [kind])
+
+
+@signals.INSTANCE_WARMUP.connect
+def PreloadDictionaries(unused_sender):
+  """Loads the dictionaries of all kinds into the instance cache on warmup."""
+  _SetDictionaries(_LoadDictionariesAsync().get_result())
+
+
+def _GetDictionaryData(dictionary_id):
+  """Returns the data of a dictionary, loading it if it isn't cached."""
+  data = _data.get(dictionary_id)
+  if data is None and dictionary_id not in _data:
+    dictionary = _LoadDictionary(dictionary_id)
+    data = dictionary and dictionary.data
+    with _lock:
+      data = _data.setdefault(dictionary_id, data)
+  return data
+
+
+def _GetDecompressor(dictionary_id):
+  """Returns a decompressor primed with a dictionary.
+
+  Args:
+    dictionary_id: str, the id of the dictionary.
+
+  Returns:
+    The primed zlib decompressor.
+
+  Raises:
+    ValueError: if the dictionary doesn't exist.
+  """
+  decompressor = _decompressors.Get(dictionary_id)
+  if decompressor is lru_cache.MISSING:
+    data = _GetDictionaryData(dictionary_id)
+    if data is None:
+      raise ValueError(
+          'Unknown JSON dictionary %s' % dictionary_id.encode('hex'))
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    decompressor.decompress(_Prime(data, zlib.Z_BEST_SPEED)[1])
+    decompressor = _decompressors.SetDefault(dictionary_id, decompressor)
+  return decompressor
+
+
+def GetCurrentDictionary(kind):
+  """Returns the latest loaded dictionary of a kind, without waiting for it.
+
+  The dictionary is cached for JSON_DICTIONARY_TIMEOUT seconds. When it is
+  missing or expired a reload is started, and the cached dictionary is
+  returned until the reload completes.
+
+  Args:
+    kind: str, the model kind.
+
+  Returns:
+    JsonDictionary, or None if the kind has no dictionary or it isn't loaded.
+  """
+  expires, dictionary = _current.get(kind, (0, None))
+  if expires < time.time():
+    _RefreshAsync(kind)
+  return dictionary
+
+
+def Compress(kind, data, level=None):
+  """Compresses a JSON string with the latest dictionary of a kind.
+
+  Args:
+    kind: str, the kind of the entity the value belongs to.
+    data: str, the JSON string.
+    level: int, the zlib compression level, or None for the default.
+
+  Returns:
+    DictCompressedValue, or a ndb compressed value if dictionary writes are
+    disabled or the kind's dictionary isn't loaded.
+  """
+  if level is None:
+    level = zlib.Z_DEFAULT_COMPRESSION
+  dictionary = None
+  if constants.JSON_DICTIONARY_WRITES_ENABLED:
+    dictionary = GetCurrentDictionary(kind)
+  if dictionary is None:
+    value = ndb_model._CompressedValue(  # pylint: disable=protected-access
+        zlib.compress(data, level))
+    stored_bytes = len(value.z_val)
+  else:
+    dictionary_id = _GetDictionaryId(dictionary.data)
+    compressor = _GetCompressor(dictionary_id, dictionary.data, level)
+    value = DictCompressedValue(
+        _PAYLOAD_PREFIX + dictionary_id + _CompressWith(compressor, data))
+    stored_bytes = len(value.payload)
+  with _lock:
+    stats = _stats[kind]
+    stats['values'] += 1
+    stats['dictionary_values'] += dictionary is not None
+    stats['raw_bytes'] += len(data)
+    stats['stored_bytes'] += stored_bytes
+  return value
+
+
+def Decompress(value):
+  """Decompresses a dictionary compressed value.
+
+  Args:
+    value: DictCompressedValue, the stored value.
+
+  Returns:
+    str, the JSON string.
+
+  Raises:
+    ValueError: if the dictionary doesn't exist or the value is corrupted.
+  """
+  offset = len(_PAYLOAD_PREFIX)
+  dictionary_id = value.payload[offset:offset + _DICTIONARY_ID_BYTES]
+  decompressor = _GetDecompressor(dictionary_id).copy()
+  try:
+    return (decompressor.decompress(
+        value.payload[offset + _DICTIONARY_ID_BYTES:]) + decompressor.flush())
+  except zlib.error as e:
+    raise ValueError(e)
+
+
+def TrainDictionary(samples, max_size=_MAX_DICTIONARY_BYTES):
+  """Builds a preset dictionary from sample JSON strings.
+
+  Runs of JSON tokens are scored by the bytes they would save: their length
+  times the number of samples they occur in. Repetition within a sample is
+  ignored, since zlib already compresses it. The best runs are kept, the most
+  valuable last so they are closest to the compressed data.
+
+  Args:
+    samples: list<str>, sample values of the kind.
+    max_size: int, the maximum size of the dictionary.
+
+  Returns:
+    str, the dictionary.
+  """
+  counts = collections.Counter()
+  for sample in samples:
+    tokens = _JSON_TOKEN_RE.findall(sample[:_MAX_SAMPLE_BYTES])
+    runs = set()
+    for n in _TRAINING_NGRAMS:
+      for i in xrange(len(tokens) - n + 1):
+        runs.add(''.join(tokens[i:i + n]))
+    counts.update(runs)
+  min_count = 2 if len(samples) > 1 else 1
+  scored = sorted(((count * len(run), run)
+                   for run, count in counts.iteritems()
+                   if count >= min_count and len(run) > 2), reverse=True)
+  picked = []
+  picked_text = ''
+  size = 0
+  for unused_score, run in scored:
+    if max_size - size < 3:
+      break
+    if size + len(run) > max_size or run in picked_text:
+      continue
+    picked.append(run)
+    picked_text += '\x00' + run
+    size += len(run)
+  return ''.join(reversed(picked))
+
+
+def TrainAndSaveDictionary(kind, samples):
+  """Trains and stores a new version of the dictionary of a kind.
+
+  Args:
+    kind: str, the model kind.
+    samples: list<str>, sample JSON values of the kind.
+
+  Returns:
+    JsonDictionary, the new dictionary, or None if nothing was learned.
+  """
+  samples = [s.encode('utf8') if isinstance(s, unicode) else s
+             for s in samples if s]
+  data = TrainDictionary(samples)
+  if not data:
+    return None
+  compressor = _Prime(data, zlib.Z_DEFAULT_COMPRESSION)[0]
+  dictionaries = _LoadDictionariesAsync(kind).get_result()
+  versions = [d.version for d in dictionaries]
+  dictionary = JsonDictionary(
+      id=_GetDictionaryId(data).encode('hex'),
+      model_kind=kind,
+      version=max(versions or [0]) + 1,
+      data=data,
+      sample_count=len(samples),
+      sample_bytes=sum(len(s) for s in samples),
+      zlib_bytes=sum(len(zlib.compress(s)) for s in samples),
+      dictionary_bytes=sum(
+          len(_PAYLOAD_PREFIX) + _DICTIONARY_ID_BYTES +
+          len(_CompressWith(compressor, s)) for s in samples))
+  dictionary.put()
+  logging.info('JSON dictionary %d of %s: %d sample bytes, %d with zlib, '
+               '%d with the dictionary', dictionary.version, kind,
+               dictionary.sample_bytes, dictionary.zlib_bytes,
+               dictionary.dictionary_bytes)
+  _SetDictionaries(dictionaries + [dictionary], [kind])
+  return dictionary
+
+
+def GetStats():
+  """Returns the compression savings since the instance started.
+
+  Returns:
+    dict<str, dict>, kind to a dict with 'values', 'dictionary_values',
+    'raw_bytes', 'stored_bytes' and 'saved_bytes' counts.
+  """
+  with _lock:
+    stats = {kind: dict(counts) for kind, counts in _stats.iteritems()}
+  for counts in stats.itervalues():
+    counts['saved_bytes'] = counts['raw_bytes'] - counts['stored_bytes']
+  return stats
@@ -0,0 +1,91 @@
+"""Thread-safe, size-bounded least recently used cache."""
+
+import collections
+import threading
+
+
+# Returned by Get() when nothing is cached, since None is a valid value.
+MISSING = object()
+
+
+class LruCache(object):
+  """Mapping that evicts its least recently used entries when full.
+
+  Usage:
+
+  >>> cache = LruCache(100)
+  >>> cache.Set('key', 'value')
+  >>> cache.Get('key')
+  'value'
+  >>> cache.Get('other') is MISSING
+  True
+  """
+
+  def __init__(self, max_size, on_evict=None):
+    """Initialization of a LruCache.
+
+    Args:
+      max_size: int, the maximum number of entries kept.
+      on_evict: function, called with (key, value) for every entry that is
+          evicted to make room for new entries. It is called without holding
+          the cache lock.
+    """
+    self._max_size = max_size
+    self._on_evict = on_evict
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def Get(self, key):
+    """Returns the cached value for key, or MISSING."""
+    with self._lock:
+      value = self._entries.pop(key, MISSING)
+      if value is not MISSING:
+        self._entries[key] = value
+      return value
+
+  def Set(self, key, value):
+    """Caches a value, evicting the least recently used entries if needed."""
+    self._Store(key, value, replace=True)
+
+  def SetDefault(self, key, value):
+    """Caches value unless key is cached already.
+
+    Args:
+      key: *, the hashable cache key.
+      value: *, the value to cache.
+
+    Returns:
+      The value cached for key after the call.
+    """
+    return self._Store(key, value, replace=False)
+
+  def _Store(self, key, value, replace):
+    """Stores value under key and returns the value cached for key."""
+    evicted = []
+    with self._lock:
+      cached = self._entries.pop(key, MISSING)
+      if replace or cached is MISSING:
+        cached = value
+      self._entries[key] = cached
+      while len(self._entries) > self._max_size:
+        evicted.append(self._entries.popitem(last=False))
+    if self._on_evict:
+      for evicted_key, evicted_value in evicted:
+        self._on_evict(evicted_key, evicted_value)
+    return cached
+
+  def Pop(self, key):
+    """Removes and returns the cached value for key, or MISSING."""
+    with self._lock:
+      return self._entries.pop(key, MISSING)
+
+  def Clear(self):
+    """Removes all entries without calling on_evict."""
+    with self._lock:
+      self._entries.clear()
@@ -1,17 +1,22 @@
 """Custom mix-in classes and properties to be used in NDB models."""
 
+import base64
+import collections
 import cPickle as pickle
 import datetime
 import decimal
 import importlib
+import itertools
+import json
 import logging
 import re
 import sys
 import threading
-import zlib
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import users
 from google.appengine.datastore import datastore_query
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import model as ndb_model
 
@@ -21,7 +26,10 @@ from _base.utils import memoize
 from _base.utils import user_utils
 from _base.utils import constants
 from _base.utils import conversion_utils
+from _base.utils import counter_models
+from _base.utils import json_compression
 from _base.utils import json_utils
+from _base.utils import query_cache
 
 
 _KIND_MAP_LOCK = threading.RLock()
@@ -34,6 +42,12 @@ _ZLIB_HEADERS = ('x\x01', 'x\x9c', 'x\xda')
 _ASC = datastore_query.PropertyOrder.ASCENDING
 _DESC = datastore_query.PropertyOrder.DESCENDING
 _SORT_SYMBOL = '-'
+_EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+# List filters are run as one concurrent query per combination of values, up
+# to this many queries. Larger fan-outs use a single IN query.
+_MAX_FANOUT_QUERIES = 30
+_FANOUT_CURSOR_PREFIX = 'fanout.'
 
 # The range [!-~] includes all printable ASCII characters other than space. The
 # range ["-~] is the same range but without '!'. So the following regexp matches
@@ -45,6 +59,10 @@ _KEY_NAME_NOMATCH = re.compile('__.*__$')
 MIN_KEY_LENGTH = 8
 MAX_KEY_LENGTH = 500
 
+# Names of the metadata_messages.ReadMode values, which can't be imported here.
+READ_MODE_QUERY = 'QUERY'
+READ_MODE_KEYS_THEN_GET = 'KEYS_THEN_GET'
+
 
 def BadKeyName(key_name):
   """Check if key_name is allowable as a model key name.
@@ -184,7 +202,8 @@ def MakePropertyNameConstants(cls):
 
 @ndb.tasklet
 def ReadAsync(model, limit=constants.LIST_MAX_LIMIT, start_cursor=None,
-              sort_by=None, filters=None):
+              sort_by=None, filters=None, use_cache=True, read_mode=None,
+              fields=None):
   """Reads the data for given entity.
 
   It's the subclass calling method that has responsibility for determining
@@ -199,35 +218,362 @@ def ReadAsync(model, limit=constants.LIST_MAX_LIMIT, start_cursor=None,
     limit: int, maximum number of records per page.
     start_cursor: string, starting cursor.
     sort_by: string, sort order.
-    filters: dict, Filter keys and their value.
+    filters: dict, Filter keys and their value. List values match any of the
+        values, and are read with one concurrent query per value. A
+        start_cursor of a single query, e.g. one returned before list filters
+        were fanned out, is resumed with a single IN query.
+    use_cache: bool, whether results may be served from and stored in the
+        query cache, if it is enabled for the kind.
+    read_mode: str or metadata_messages.ReadMode, READ_MODE_QUERY to read
+        entities from the query or READ_MODE_KEYS_THEN_GET to read keys from
+        the query and entities by key, using the ndb caches. Defaults to the
+        read_mode of the kind's metadata. List filters that fan out always
+        read entities from the queries. Unlike queries, reads by key fire the
+        pre and post get hooks and the MODEL_PRE_GET and MODEL_POST_GET
+        signals for every entity, and may return the instances cached in the
+        ndb context rather than copies.
+    fields: list<str>, the names of the properties to return. Whole entities
+        are read, then trimmed to these properties, so this only makes the
+        response smaller. Other properties of the returned entities can't be
+        read. All properties are returned if omitted.
 
   Yields:
     tuple, (list<Model>, string cursor, boolean more).
   """
-  if start_cursor:
-    start_cursor = datastore_query.Cursor(urlsafe=start_cursor)
   if limit is None:
     limit = constants.LIST_MAX_LIMIT
+  if fields:
+    fields = tuple(sorted(set(fields)))
+  # pylint: disable=protected-access
+  cache_key = None
+  if use_cache:
+    cache_key = query_cache.GetKey(
+        model._get_kind(), 'Read', limit=limit, start_cursor=start_cursor,
+        sort_by=sort_by, filters=filters, fields=fields)
+  if cache_key:
+    cached = query_cache.Get(cache_key)
+    if cached is not query_cache.MISSING:
+      pbs, cursor, more = cached
+      entities = [model._from_pb(entity_pb.EntityProto(pb)) for pb in pbs]
+      if fields:
+        entities = [_TrimEntity(entity, fields) for entity in entities]
+      raise ndb.Return((entities, cursor, more))
+  # pylint: enable=protected-access
+
+  list_filters = _GetFanOutFilters(filters)
+  if list_filters and not (
+      start_cursor and not start_cursor.startswith(_FANOUT_CURSOR_PREFIX)):
+    entities, cursor, more = yield _ReadFanOutAsync(
+        model, limit, start_cursor, sort_by, filters, list_filters)
+    if fields:
+      entities = [_TrimEntity(entity, fields) for entity in entities]
+  else:
+    entities, cursor, more = yield _ReadQueryAsync(
+        model, limit, start_cursor, sort_by, filters, read_mode, fields)
+  if cache_key:
+    pbs = [entity._to_pb().Encode()  # pylint: disable=protected-access
+           for entity in entities]
+    query_cache.Set(cache_key, (pbs, cursor, more))
+  raise ndb.Return((entities, cursor, more))
+
+
+@ndb.tasklet
+def _ReadQueryAsync(model, limit, start_cursor, sort_by, filters, read_mode,
+                    fields):
+  """Reads a page of the data for given entity with a single query."""
+  if start_cursor:
+    start_cursor = datastore_query.Cursor(urlsafe=start_cursor)
 
   query = _CreateQueryForModel(model)
   query = _AddQueryFilters(model, query, filters)
   query = _AddQuerySort(query, sort_by)
 
-  entities, cursor, more = yield query.fetch_page_async(
-      limit, start_cursor=start_cursor)
+  if read_mode is None:
+    read_mode = getattr(getattr(model, '_meta', None), 'read_mode', None)
+  if str(read_mode) == READ_MODE_KEYS_THEN_GET:
+    keys, cursor, more = yield query.fetch_page_async(
+        limit, start_cursor=start_cursor, keys_only=True)
+    entities = yield ndb.get_multi_async(keys)
+    # Skip entities deleted since the query's index was read.
+    entities = [entity for entity in entities if entity is not None]
+  else:
+    entities, cursor, more = yield query.fetch_page_async(
+        limit, start_cursor=start_cursor)
+  if fields:
+    entities = [_TrimEntity(entity, fields) for entity in entities]
   if cursor:
     cursor = cursor.urlsafe()
   raise ndb.Return((entities, cursor, more))
 
 
+class _Descending(object):
+  """Wraps a sort value to invert its order in the merge."""
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+
+def _GetFanOutFilters(filters):
+  """Returns the list filters to fan out over, if the query should fan out.
+
+  Args:
+    filters: dict, Filter keys and their value.
+
+  Returns:
+    list<(str, list)>, filter keys with their distinct values sorted by key, or
+    None if there are no list filters with several values or too many value
+    combinations.
+  """
+  list_filters = []
+  queries = 1
+  for key, value in sorted((filters or {}).iteritems()):
+    if not isinstance(value, (list, set, tuple)) or len(value) < 2:
+      continue
+    values = []
+    for v in value:
+      if v not in values:
+        values.append(v)
+    list_filters.append((key, values))
+    queries *= len(values)
+  if not list_filters or queries > _MAX_FANOUT_QUERIES:
+    return None
+  return list_filters
+
+
+def _ToUtf8(value):
+  return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def _ToMicroseconds(value):
+  """Returns a date, time or datetime as microseconds since the epoch."""
+  if isinstance(value, datetime.datetime):
+    if value.tzinfo:
+      value = (value - value.utcoffset()).replace(tzinfo=None)
+  elif isinstance(value, datetime.date):
+    value = datetime.datetime.combine(value, datetime.time())
+  else:
+    value = datetime.datetime.combine(_EPOCH.date(), value.replace(tzinfo=None))
+  delta = value - _EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _GetKeyOrder(key):
+  """Returns a value that sorts keys in datastore order."""
+  return (key.app(), key.namespace(), tuple(
+      (_ToUtf8(kind), (0, id_or_name) if isinstance(id_or_name, (int, long))
+       else (1, _ToUtf8(id_or_name)))
+      for kind, id_or_name in key.pairs()))
+
+
+def _GetValueOrder(value):
+  """Returns a value that sorts property values in datastore order.
+
+  The datastore orders values of different types by type, in the order null,
+  integers and date-times, booleans, strings, floats, geographical points,
+  users and keys, then values of the same type by their stored form, e.g.
+  strings by their UTF-8 bytes and date-times in UTC.
+
+  Args:
+    value: a property value as read by ndb.
+
+  Returns:
+    tuple, (type rank, comparable value).
+  """
+  if value is None:
+    return (0, None)
+  if isinstance(value, bool):
+    return (2, value)
+  if isinstance(value, (int, long)):
+    return (1, value)
+  if isinstance(value, (datetime.date, datetime.time)):
+    return (1, _ToMicroseconds(value))
+  if isinstance(value, basestring):
+    return (4, _ToUtf8(value))
+  if isinstance(value, float):
+    return (5, value)
+  if isinstance(value, ndb.GeoPt):
+    return (6, (value.lat, value.lon))
+  if isinstance(value, users.User):
+    return (7, (_ToUtf8(value.email()), _ToUtf8(value.auth_domain())))
+  if isinstance(value, ndb.Key):
+    return (8, _GetKeyOrder(value))
+  return (9, value)
+
+
+def _GetSortValue(entity, sort_by):
+  """Returns the order of entity in a query ordered by sort_by."""
+  if not sort_by:
+    return None
+  descending = sort_by[0] == _SORT_SYMBOL
+  name = sort_by[1:] if descending else sort_by
+  # pylint: disable=protected-access
+  prop = entity._properties.get(name)
+  value = prop._get_value(entity) if prop else None
+  # pylint: enable=protected-access
+  if isinstance(value, list):
+    # Repeated properties sort on their smallest or largest value.
+    order = (max if descending else min)(
+        _GetValueOrder(v) for v in value) if value else _GetValueOrder(None)
+  else:
+    order = _GetValueOrder(value)
+  return _Descending(order) if descending else order
+
+
+def _EncodeFanOutCursor(states):
+  return _FANOUT_CURSOR_PREFIX + base64.urlsafe_b64encode(json.dumps(states))
+
+
+def _DecodeFanOutCursor(cursor, size):
+  """Decodes the per-query states of a fan-out cursor.
+
+  Args:
+    cursor: string, the cursor returned by a previous fan-out read.
+    size: int, the number of queries of the fan-out.
+
+  Returns:
+    list, for each query None to start from the beginning, False if the query
+    is exhausted, or [urlsafe cursor or None, offset] to skip offset results
+    after the cursor.
+
+  Raises:
+    datastore_errors.BadValueError: if the cursor is not a valid fan-out cursor
+        for this query.
+  """
+  states = None
+  if cursor.startswith(_FANOUT_CURSOR_PREFIX):
+    try:
+      states = json.loads(base64.urlsafe_b64decode(
+          str(cursor[len(_FANOUT_CURSOR_PREFIX):])))
+    except (TypeError, ValueError):
+      pass
+  if not isinstance(states, list) or len(states) != size:
+    raise datastore_errors.BadValueError(error_msg.INVALID_CURSOR % cursor)
+  for i, state in enumerate(states):
+    if isinstance(state, basestring):
+      # Cursors of fan-out reads that resumed each query from a cursor.
+      states[i] = [state, 0]
+  return states
+
+
+@ndb.tasklet
+def _ReadFanOutAsync(model, limit, start_cursor, sort_by, filters,
+                     list_filters):
+  """Reads the data for list filters by merging one query per value.
+
+  Each combination of list filter values is queried with equality filters and
+  ordered by sort_by then key. The queries are read concurrently in batches and
+  merged in datastore order, and entities matched by several queries are
+  returned once. The first batch of each query is a share of limit, and a query
+  whose batch was merged is read again with twice its previous batch, so at
+  most a few times limit entities are read per page. A query whose batch was
+  only partly merged resumes from the cursor of that batch, skipping the merged
+  entities.
+
+  Args:
+    model: class, the model to read.
+    limit: int, maximum number of records per page.
+    start_cursor: string, a cursor returned by a previous fan-out read.
+    sort_by: string, sort order.
+    filters: dict, Filter keys and their value.
+    list_filters: list<(str, list)>, the list filters to fan out over, as
+        returned by _GetFanOutFilters.
+
+  Yields:
+    tuple, (list<Model>, string cursor, boolean more).
+  """
+  list_keys = [key for key, _ in list_filters]
+  base_query = _CreateQueryForModel(model)
+  base_query = _AddQueryFilters(model, base_query, dict(
+      (key, value) for key, value in filters.iteritems()
+      if key not in list_keys))
+
+  combinations = list(itertools.product(
+      *[values for _, values in list_filters]))
+  if start_cursor:
+    states = _DecodeFanOutCursor(start_cursor, len(combinations))
+  else:
+    states = [None] * len(combinations)
+
+  queries = {}
+  for i, combination in enumerate(combinations):
+    if states[i] is False:
+      continue
+    query = base_query
+    for key, value in zip(list_keys, combination):
+      query = query.filter(ndb.FilterNode(key, '=', value))
+    queries[i] = _AddQuerySort(query, sort_by).order(model.key)
+    states[i] = list(states[i] or (None, 0))
+
+  # For each query, the entities read but not merged yet with their order, the
+  # cursor after them and the size of its next batch. states[i] is the cursor
+  # and offset of the first entity not merged, or False once exhausted.
+  buffers = dict((i, collections.deque()) for i in queries)
+  next_cursors = {}
+  batch_sizes = dict.fromkeys(queries, -(-limit // max(len(queries), 1)))
+  entities = []
+
+  @ndb.tasklet
+  def _FetchAsync(i):
+    cursor, offset = states[i]
+    if cursor:
+      cursor = datastore_query.Cursor(urlsafe=cursor)
+    size = min(batch_sizes[i], limit - len(entities))
+    page, cursor, more = yield queries[i].fetch_page_async(
+        size, start_cursor=cursor, offset=offset)
+    batch_sizes[i] = 2 * size
+    next_cursors[i] = cursor.urlsafe() if more and cursor else None
+    if not page:
+      states[i] = False
+    for entity in page:
+      buffers[i].append(((_GetSortValue(entity, sort_by),
+                          _GetKeyOrder(entity.key)), entity))
+
+  def _Pop(i):
+    buffers[i].popleft()
+    if buffers[i]:
+      states[i][1] += 1
+    else:
+      states[i] = [next_cursors[i], 0] if next_cursors[i] else False
+
+  while len(entities) < limit:
+    # An entity can only be merged once every query that isn't exhausted has
+    # read an entity, as the next entity of any of them may come first.
+    empty = [i for i in queries if not buffers[i] and states[i] is not False]
+    if empty:
+      yield [_FetchAsync(i) for i in empty]
+      continue
+    heads = [i for i in queries if buffers[i]]
+    if not heads:
+      break
+    order, entity = buffers[min(heads, key=lambda i: buffers[i][0][0])][0]
+    entities.append(entity)
+    for i in heads:
+      # Pop the entity from all the queries that returned it.
+      if buffers[i][0][0][1] == order[1]:
+        _Pop(i)
+
+  more = any(state is not False for state in states)
+  raise ndb.Return((entities, _EncodeFanOutCursor(states), more))
+
+
 def Read(model, limit=constants.LIST_MAX_LIMIT, start_cursor=None,
-         sort_by=None, filters=None):
+         sort_by=None, filters=None, use_cache=True, read_mode=None,
+         fields=None):
   return ReadAsync(model, limit=limit, start_cursor=start_cursor,
-                   sort_by=sort_by, filters=filters).get_result()
+                   sort_by=sort_by, filters=filters, use_cache=use_cache,
+                   read_mode=read_mode, fields=fields).get_result()
 
 
 @ndb.tasklet
-def CountAsync(model, limit=None, filters=None):
+def CountAsync(model, limit=None, filters=None, use_cache=True):
   """Returns the count of entities matching the query filters.
 
   Example:
@@ -236,19 +582,47 @@ def CountAsync(model, limit=None, filters=None):
   Args:
     model: class, The model to read.
     limit: int, Maximum number of results to count.
-    filters: dict, Filter keys and their value.
+    filters: dict, Filter keys and their value. The count is read from a
+        counter if one is declared for the kind and exactly these filters, see
+        counter_models.
+    use_cache: bool, whether the count may be served from and stored in the
+        query cache, if it is enabled for the kind.
 
   Yields:
     int, Count of entities matching the criteria.
   """
-  query = _CreateQueryForModel(model)
-  query = _AddQueryFilters(model, query, filters)
-  count = yield query.count_async(limit=limit)
+  kind = model._get_kind()  # pylint: disable=protected-access
+  cache_key = None
+  if use_cache:
+    cache_key = query_cache.GetKey(kind, 'Count', limit=limit, filters=filters)
+  if cache_key:
+    count = query_cache.Get(cache_key)
+    if count is not query_cache.MISSING:
+      raise ndb.Return(count)
+  counter = counter_models.GetCounter(kind, filters)
+  if counter:
+    # Deletes and transactional puts of this request may still be updating
+    # the counter, while the query cache already moved to a new generation.
+    try:
+      yield counter_models.WaitForPendingUpdatesAsync(kind)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Failed to update the counters of %s.', kind)
+      cache_key = None
+    count = yield counter_models.GetCountAsync(counter)
+    if limit is not None:
+      count = min(count, limit)
+  else:
+    query = _CreateQueryForModel(model)
+    query = _AddQueryFilters(model, query, filters)
+    count = yield query.count_async(limit=limit)
+  if cache_key:
+    query_cache.Set(cache_key, count)
   raise ndb.Return(count)
 
 
-def Count(model, limit=None, filters=None):
-  return CountAsync(model, limit=limit, filters=filters).get_result()
+def Count(model, limit=None, filters=None, use_cache=True):
+  return CountAsync(model, limit=limit, filters=filters,
+                    use_cache=use_cache).get_result()
 
 
 @ndb.tasklet
@@ -273,6 +647,95 @@ def Exists(model, filters=None):
   return ExistsAsync(model, filters=filters).get_result()
 
 
+class PagedReader(object):
+  """Iterates over all entities matching a query, page by page.
+
+  Pages are read with ReadAsync. The next pages are fetched while the current
+  page is being consumed, up to prefetch pages ahead, so scans are limited by
+  throughput rather than by round-trip latency.
+
+  The cursor attribute is a checkpoint: it is the cursor after the last page
+  that was fully consumed, and can be passed as start_cursor to resume.
+
+  Example:
+    reader = PagedReader(TestModel, filters={'boolean_property': True})
+    for entity in reader:
+      Process(entity)
+      checkpoint = reader.cursor
+  """
+
+  def __init__(self, model, page_size=constants.LIST_MAX_LIMIT,
+               start_cursor=None, sort_by=None, filters=None, prefetch=1):
+    """Initialization of a PagedReader.
+
+    Args:
+      model: class, the model to read.
+      page_size: int, maximum number of records per page.
+      start_cursor: string, starting cursor.
+      sort_by: string, sort order.
+      filters: dict, Filter keys and their value.
+      prefetch: int, maximum number of pages fetched ahead of the page being
+          consumed.
+    """
+    self.cursor = start_cursor
+    self.done = False
+    self._model = model
+    self._page_size = page_size
+    self._sort_by = sort_by
+    self._filters = filters
+    self._prefetch = max(prefetch, 1)
+    # Futures of the pages that have not been consumed yet, in order.
+    self._pages = collections.deque()
+    # Cursor of the next page, if fetching it was deferred.
+    self._next_cursor = None
+
+  def __iter__(self):
+    for entities in self.IterPages():
+      for entity in entities:
+        yield entity
+
+  def _Fetch(self, cursor):
+    """Starts fetching the page at cursor."""
+    future = ReadAsync(self._model, limit=self._page_size, start_cursor=cursor,
+                       sort_by=self._sort_by, filters=self._filters)
+    self._pages.append(future)
+    # Callbacks added with add_callback only run when the event loop is
+    # spun, which a consumer that makes no ndb calls doesn't do.
+    future.add_immediate_callback(self._OnFetched, future)
+
+  def _OnFetched(self, future):
+    """Starts fetching the next page if fewer than prefetch pages are ahead."""
+    if future.get_exception():
+      return  # Raised when the page is consumed.
+    unused_entities, cursor, more = future.get_result()
+    if more and cursor:
+      if len(self._pages) < self._prefetch:
+        self._Fetch(cursor)
+      else:
+        self._next_cursor = cursor
+
+  def IterPages(self):
+    """Yields the entities of every page.
+
+    Yields:
+      list<Model>, the entities of a page.
+    """
+    if self.done:
+      return
+    self._Fetch(self.cursor)
+    while self._pages:
+      future = self._pages.popleft()
+      entities, cursor, more = future.get_result()
+      if self._next_cursor and len(self._pages) < self._prefetch:
+        next_cursor, self._next_cursor = self._next_cursor, None
+        self._Fetch(next_cursor)
+      if entities:
+        yield entities
+      # The page has been consumed.
+      self.cursor = cursor or self.cursor
+      self.done = not (more and cursor)
+
+
 def _CreateQueryForModel(model):
   """Creates a NDB query for a model.
 
@@ -331,17 +794,83 @@ def _AddQuerySort(query, sort_by):
   return query
 
 
+def _GetQueryProperty(model, name):
+  """Returns the property of a model, including properties from metadata."""
+  prop = model._properties.get(name)  # pylint: disable=protected-access
+  meta = getattr(model, '_meta', None)
+  if prop is None and meta is not None:
+    # Avoid circular import, pylint: disable=g-import-not-at-top
+    from _base.metadata import metadata_utils
+    # pylint: enable=g-import-not-at-top
+    field = metadata_utils.GetFieldByName(meta, name)
+    if field:
+      prop = metadata_utils.GetFieldProperty(field)
+  return prop
+
+
+def _TrimEntity(entity, fields):
+  """Returns a copy of an entity with the values of some properties only.
+
+  The copy behaves like the result of a projection query: its other properties
+  can't be read and it can't be modified. The entity itself may be shared by
+  the ndb context cache, so it is left untouched.
+
+  Args:
+    entity: ndb.Model, the entity to trim.
+    fields: tuple<str>, the names of the properties to keep.
+
+  Returns:
+    ndb.Model, the trimmed copy.
+  """
+  # pylint: disable=protected-access
+  trimmed = entity.__class__(key=entity.key)
+  if entity._properties is not entity.__class__._properties:
+    trimmed._properties = dict(entity._properties)
+  trimmed._values = dict((name, value)
+                         for name, value in entity._values.iteritems()
+                         if name in fields)
+  trimmed._set_projection(fields)
+  # pylint: enable=protected-access
+  return trimmed
+
+
 class DHJsonProperty(ndb.TextProperty):
   """Custom JsonProperty.
 
   Handles broken compressed, None, and pickled values. It also automatically
-  compresses values that are too large.
+  compresses values that are too large, with the JSON compression dictionary
+  of the entity's kind if dictionary writes are enabled and it has one (see
+  json_compression).
   """
 
+  def __init__(self, name=None, compression_level=None,
+               compression_threshold=None, **kwargs):
+    """Initialization of a DHJsonProperty.
+
+    Args:
+      name: str, the property name.
+      compression_level: int, the zlib compression level from 0 to 9, or None
+          for the default.
+      compression_threshold: int, the total size in bytes of the values above
+          which they are compressed, or None for the default.
+      **kwargs: dict, Inherited keyword arguments.
+    """
+    super(DHJsonProperty, self).__init__(name=name, **kwargs)
+    if compression_level is not None:
+      compression_level = min(max(compression_level, 0), 9)
+    self._compression_level = compression_level
+    self._compression_threshold = compression_threshold
+
   def _to_base_type(self, value):
     return json_utils.Dump(value)
 
   def _from_base_type(self, value):
+    if isinstance(value, json_compression.DictCompressedValue):
+      try:
+        value = json_compression.Decompress(value)
+      except ValueError as err:
+        logging.error(error_msg.JSON_PARSE_FAIL, err)
+        return None
     try:
       return json_utils.Load(value)
     except ValueError as err:
@@ -359,18 +888,34 @@ class DHJsonProperty(ndb.TextProperty):
       return None
 
   def _get_base_value_unwrapped_as_list(self, entity):
-    """Overridden to handle automatic compression."""
+    """Overridden to handle automatic compression.
+
+    Values that were loaded and never read are still in their stored form, so
+    they are written back as is. Only raw strings are compressed.
+    """
     values = super(DHJsonProperty, self)._get_base_value_unwrapped_as_list(
         entity)
-    if not self._compressed and sum(
-        len(v) for v in values if isinstance(v, str)) > _JSON_MAX_RAW_BYTES:
-      for i, val in enumerate(values):
-        if val:
-          # pylint: disable=protected-access
-          values[i] = ndb_model._CompressedValue(zlib.compress(val))
-          # pylint: enable=protected-access
+    if self._compressed:
+      return values
+    threshold = self._compression_threshold
+    if threshold is None:
+      threshold = _JSON_MAX_RAW_BYTES
+    raw = [i for i, val in enumerate(values) if isinstance(val, str) and val]
+    if sum(len(values[i]) for i in raw) > threshold:
+      kind = entity._get_kind()  # pylint: disable=protected-access
+      for i in raw:
+        values[i] = json_compression.Compress(
+            kind, values[i], self._compression_level)
     return values
 
+  def _db_set_value(self, v, p, value):
+    """Overridden to store dictionary compressed values."""
+    if isinstance(value, json_compression.DictCompressedValue):
+      self._db_set_compressed_meaning(p)
+      v.set_stringvalue(value.payload)
+    else:
+      super(DHJsonProperty, self)._db_set_value(v, p, value)
+
   def _get_user_value(self, entity):
     """Overridden to handle repeated None values."""
     value = super(DHJsonProperty, self)._get_user_value(entity)
@@ -384,6 +929,25 @@ class DHJsonProperty(ndb.TextProperty):
           value[i] = None
     return value
 
+  def _opt_call_from_base_type(self, value):
+    """Overridden to decode dictionary compressed values.
+
+    They are stored as compressed values, so they must be recognized before
+    ndb tries to decompress them. Values loaded by a generic property before
+    the entity got this property are recognized as well.
+    """
+    # pylint: disable=protected-access
+    if isinstance(value, ndb_model._BaseValue):
+      stored = value.b_val
+      if isinstance(stored, ndb_model._CompressedValue):
+        stored = stored.z_val
+      # Restoring from backup loses compression information.
+      if isinstance(stored, str) and json_compression.IsPayload(stored):
+        value = ndb_model._BaseValue(
+            json_compression.DictCompressedValue(stored))
+    # pylint: enable=protected-access
+    return super(DHJsonProperty, self)._opt_call_from_base_type(value)
+
   def _db_get_value(self, v, p):
     """Overridden to handle corrupted compressed values."""
     value = super(DHJsonProperty, self)._db_get_value(v, p)
@@ -394,12 +958,49 @@ class DHJsonProperty(ndb.TextProperty):
     return value
 
 
+def TrainJsonDictionary(model, sample_size=100):
+  """Trains a new JSON compression dictionary for a model from stored values.
+
+  Args:
+    model: class, the model whose DHJsonProperty values are sampled.
+    sample_size: int, the number of entities to sample.
+
+  Returns:
+    json_compression.JsonDictionary, the new dictionary, or None.
+  """
+  samples = []
+  # pylint: disable=protected-access
+  for entity in model.query().fetch(sample_size):
+    for name in entity._values.keys():
+      prop = _GetQueryProperty(model, name)
+      if isinstance(prop, DHJsonProperty):
+        value = prop._get_value(entity)
+        for v in value if prop._repeated else [value]:
+          if v is not None:
+            samples.append(json_utils.Dump(v))
+  kind = model._get_kind()
+  # pylint: enable=protected-access
+  return json_compression.TrainAndSaveDictionary(kind, samples)
+
+
 class DHLocalStructuredProperty(ndb.LocalStructuredProperty):
   """Custom LocalStructuredProperty.
 
-  Handles broken compressed values.
+  Handles broken compressed values, and doesn't decode values that were never
+  read when the entity is put.
   """
 
+  def _prepare_for_put(self, entity):
+    """Overridden to skip values that are still in their stored form."""
+    values = self._retrieve_value(entity)
+    if not self._repeated:
+      values = [values]
+    for value in values or ():
+      # pylint: disable=protected-access
+      if value is not None and not isinstance(value, ndb_model._BaseValue):
+        value._prepare_for_put()
+      # pylint: enable=protected-access
+
   def _db_get_value(self, v, p):
     """Overridden to handle corrupted compressed values."""
     value = super(DHLocalStructuredProperty, self)._db_get_value(v, p)
@@ -0,0 +1,115 @@
+"""Benchmarks ReadAsync against the datastore stub of the testbed.
+
+Reads every page of entities matching a list filter with a single IN query,
+as ReadAsync did before, and with one concurrent query per value merged by
+ReadAsync.
+
+Reads a page of entities in the QUERY and KEYS_THEN_GET read modes, with cold
+caches, with the entities in memcache and with the entities in the ndb
+context cache.
+
+Usage:
+
+  python -m _base.utils.model_utils_benchmark
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from _base.utils import benchmark_utils
+from _base.utils import model_utils
+
+_ENTITIES = 2000
+_PAGE_SIZES = (20, 100, 500)
+_VALUE_COUNTS = (2, 5, 10)
+_READ_MODE_PAGE_SIZE = 100
+
+
+class BenchmarkEntity(ndb.Model):
+  group = ndb.IntegerProperty()
+  rank = ndb.IntegerProperty()
+
+
+def _ReadAllWithIn(values, limit):
+  query = BenchmarkEntity.query(BenchmarkEntity.group.IN(values)).order(
+      BenchmarkEntity.rank, BenchmarkEntity.key)
+  cursor, more = None, True
+  while more:
+    _, cursor, more = query.fetch_page(limit, start_cursor=cursor)
+
+
+def _ReadAllWithFanOut(values, limit):
+  cursor, more = None, True
+  while more:
+    _, cursor, more = model_utils.Read(
+        BenchmarkEntity, limit=limit, start_cursor=cursor, sort_by='rank',
+        filters={'group': values}, use_cache=False)
+
+
+def _ClearCaches(memcache_too):
+  ndb.get_context().clear_cache()
+  if memcache_too:
+    memcache.flush_all()
+
+
+def _BenchmarkListFilters():
+  ndb.get_context().set_cache_policy(False)
+  ndb.get_context().set_memcache_policy(False)
+  rows = []
+  for value_count in _VALUE_COUNTS:
+    values = range(value_count)
+    for limit in _PAGE_SIZES:
+      in_query = benchmark_utils.Time(
+          lambda: _ReadAllWithIn(values, limit), number=1)
+      fan_out = benchmark_utils.Time(
+          lambda: _ReadAllWithFanOut(values, limit), number=1)
+      rows.append([value_count, limit, in_query, fan_out,
+                   '%.1fx' % (in_query / fan_out)])
+  benchmark_utils.PrintTable(
+      'Reading %d entities by pages (us, datastore stub)' % _ENTITIES,
+      ['values', 'page size', 'IN query', 'fan-out', 'speedup'], rows)
+
+
+def _BenchmarkReadModes():
+  ndb.get_context().set_cache_policy(None)
+  ndb.get_context().set_memcache_policy(None)
+  rows = []
+  for caches, clear, memcache_too in (('cold', True, True),
+                                      ('memcache', True, False),
+                                      ('context', False, False)):
+    times = []
+    for read_mode in (model_utils.READ_MODE_QUERY,
+                      model_utils.READ_MODE_KEYS_THEN_GET):
+
+      def _Read():
+        if clear:
+          _ClearCaches(memcache_too)
+        model_utils.Read(BenchmarkEntity, limit=_READ_MODE_PAGE_SIZE,
+                         sort_by='rank', use_cache=False, read_mode=read_mode)
+
+      _Read()  # Fills the caches of the warm cases.
+      times.append(benchmark_utils.Time(_Read))
+    rows.append([caches] + times + ['%.1fx' % (times[0] / times[1])])
+  benchmark_utils.PrintTable(
+      'Reading a page of %d entities (us, datastore stub)' % (
+          _READ_MODE_PAGE_SIZE),
+      ['caches', 'QUERY', 'KEYS_THEN_GET', 'speedup'], rows)
+
+
+def main():
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  try:
+    ndb.put_multi([BenchmarkEntity(group=i % max(_VALUE_COUNTS), rank=i // 7)
+                   for i in xrange(_ENTITIES)])
+    _BenchmarkListFilters()
+    _BenchmarkReadModes()
+  finally:
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+  main()
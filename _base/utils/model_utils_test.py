@@ -0,0 +1,168 @@
+"""Tests for model_utils."""
+
+import unittest
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from _base.utils import model_utils
+
+
+class ReadModel(ndb.Model):
+  group = ndb.IntegerProperty()
+  rank = ndb.IntegerProperty()
+
+
+class FanOutModel(ndb.Model):
+  group = ndb.IntegerProperty()
+  rank = ndb.IntegerProperty()
+  tags = ndb.StringProperty(repeated=True)
+  scores = ndb.IntegerProperty(repeated=True)
+
+
+class PagedReaderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.keys = ndb.put_multi([ReadModel(group=i % 3, rank=i)
+                               for i in xrange(7)])
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testReadsAllPagesWithoutOtherNdbCalls(self):
+    for prefetch in (1, 2, 5):
+      reader = model_utils.PagedReader(
+          ReadModel, page_size=2, sort_by='rank', prefetch=prefetch)
+      self.assertEqual(range(7), [entity.rank for entity in reader])
+      self.assertTrue(reader.done)
+
+  def testIterPages(self):
+    reader = model_utils.PagedReader(ReadModel, page_size=3, sort_by='rank')
+    pages = [[entity.rank for entity in page] for page in reader.IterPages()]
+    self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], pages)
+    self.assertTrue(reader.done)
+
+  def testResumesFromCursor(self):
+    reader = model_utils.PagedReader(ReadModel, page_size=3, sort_by='rank')
+    pages = reader.IterPages()
+    self.assertEqual([0, 1, 2], [entity.rank for entity in next(pages)])
+    # A page is only consumed once the next one is requested.
+    self.assertIsNone(reader.cursor)
+    self.assertEqual([3, 4, 5], [entity.rank for entity in next(pages)])
+    resumed = model_utils.PagedReader(
+        ReadModel, page_size=3, sort_by='rank', start_cursor=reader.cursor)
+    self.assertEqual([3, 4, 5, 6], [entity.rank for entity in resumed])
+
+
+class ReadFanOutTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.entities = [
+        FanOutModel(id=i, group=i % 4, rank=i % 7,
+                    tags=['t%d' % (i % 3), 't%d' % (i % 5)],
+                    scores=[i % 11, i * 7 % 13])
+        for i in xrange(1, 41)]
+    ndb.put_multi(self.entities)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _ReadAll(self, limit, sort_by, filters):
+    """Reads all the pages of a fan-out read, checking each page size."""
+    ids = []
+    cursor, more = None, True
+    while more:
+      page, cursor, more = model_utils.Read(
+          FanOutModel, limit=limit, start_cursor=cursor, sort_by=sort_by,
+          filters=filters, use_cache=False)
+      self.assertLessEqual(len(page), limit)
+      if more:
+        self.assertEqual(limit, len(page))
+        self.assertTrue(cursor.startswith('fanout.'))
+      ids.extend(entity.key.id() for entity in page)
+    return ids
+
+  def _Expected(self, matches, order):
+    return [entity.key.id() for entity in sorted(
+        (entity for entity in self.entities if matches(entity)),
+        key=lambda entity: (order(entity), entity.key.id()))]
+
+  def testMultiplePages(self):
+    expected = self._Expected(lambda entity: entity.group in (0, 1, 3),
+                              lambda entity: entity.rank)
+    for limit in (1, 4, 7, 100):
+      self.assertEqual(expected, self._ReadAll(
+          limit, 'rank', {'group': [0, 1, 3]}))
+
+  def testDuplicatesAcrossValues(self):
+    expected = self._Expected(
+        lambda entity: set(entity.tags) & set(['t0', 't1', 't2']),
+        lambda entity: entity.rank)
+    for limit in (3, 10):
+      self.assertEqual(expected, self._ReadAll(
+          limit, 'rank', {'tags': ['t0', 't1', 't2']}))
+
+  def testDescendingSort(self):
+    expected = self._Expected(lambda entity: entity.group in (1, 2),
+                              lambda entity: -entity.rank)
+    self.assertEqual(expected, self._ReadAll(
+        3, '-rank', {'group': [1, 2]}))
+
+  def testRepeatedPropertySort(self):
+    matches = lambda entity: entity.group in (0, 2)
+    self.assertEqual(
+        self._Expected(matches, lambda entity: min(entity.scores)),
+        self._ReadAll(4, 'scores', {'group': [0, 2]}))
+    self.assertEqual(
+        self._Expected(matches, lambda entity: -max(entity.scores)),
+        self._ReadAll(4, '-scores', {'group': [0, 2]}))
+
+  def testResumesFromCursor(self):
+    filters = {'group': [0, 1]}
+    expected = self._Expected(lambda entity: entity.group in (0, 1),
+                              lambda entity: entity.rank)
+    first, cursor, more = model_utils.Read(
+        FanOutModel, limit=5, sort_by='rank', filters=filters,
+        use_cache=False)
+    self.assertTrue(more)
+    # Resuming twice from the same cursor returns the same page.
+    for _ in xrange(2):
+      second, _, _ = model_utils.Read(
+          FanOutModel, limit=5, start_cursor=cursor, sort_by='rank',
+          filters=filters, use_cache=False)
+      self.assertEqual(expected[:10],
+                       [entity.key.id() for entity in first + second])
+
+  def testFieldsTrimEntities(self):
+    for filters in ({'group': 1}, {'group': [1, 2]}):
+      page, _, _ = model_utils.Read(
+          FanOutModel, limit=3, sort_by='rank', filters=filters,
+          fields=['rank'], use_cache=False)
+      self.assertEqual(3, len(page))
+      for entity in page:
+        self.assertIsNotNone(entity.rank)
+        self.assertRaises(ndb.UnprojectedPropertyError, getattr, entity,
+                          'group')
+    # The entities in the context cache are left whole.
+    self.assertEqual(1, ndb.Key(FanOutModel, 1).get().group)
+
+  def testInvalidCursor(self):
+    self.assertRaises(
+        datastore_errors.BadValueError, model_utils.Read, FanOutModel,
+        limit=5, start_cursor='fanout.bm90IGpzb24=', sort_by='rank',
+        filters={'group': [0, 1]}, use_cache=False)
+
+
+if __name__ == '__main__':
+  unittest.main()
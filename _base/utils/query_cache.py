@@ -0,0 +1,191 @@
+"""Opt-in, per-instance cache of query results.
+
+Results are cached per kind under a fingerprint of the query parameters and
+the kind's generation counter. The generation is kept in memcache and bumped
+whenever a put or delete of an entity of the kind is committed, so every
+instance stops serving stale results on the first request that sees the new
+generation. The generation is read at most once per request and kind. Entries
+also expire after a per-kind TTL, and the least recently used entries are
+evicted when the cache is full.
+
+Only kinds of models that use signals.SignalMixin can be cached, since writes
+are detected by the MODEL_POST_PUT and MODEL_POST_DELETE signals.
+
+Usage:
+
+  query_cache.Enable('MyModel', ttl=300)
+  entities, cursor, more = model_utils.Read(MyModel, filters={...})
+"""
+
+import collections
+import cPickle as pickle
+import hashlib
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from _base.utils import constants
+from _base.utils import json_utils
+from _base.utils import lru_cache
+from _base.utils import request_state
+from _base.utils import signals
+
+
+# Returned by Get() when nothing is cached, since None is a valid value.
+MISSING = lru_cache.MISSING
+
+_GENERATIONS_VAR = 'query_cache_generations'
+
+_lock = threading.Lock()
+_ttls = {}
+_entries = lru_cache.LruCache(constants.QUERY_CACHE_MAX_ENTRIES)
+_hits = collections.Counter()
+_misses = collections.Counter()
+
+
+def _InitialGeneration():
+  """Returns a seed generation that is newer than any previously issued one."""
+  return int(time.time() * 1000)
+
+
+def _OnModelChanged(sender, **unused_kwargs):
+  # In a transaction, results read before the commit would be cached under the
+  # new generation, so the generation is bumped once the write is committed.
+  ndb.get_context().call_on_commit(lambda: BumpGeneration(sender))
+
+
+def Enable(kind, ttl=constants.QUERY_CACHE_DEFAULT_TTL):
+  """Enables caching of query results for a kind.
+
+  Args:
+    kind: str, the model kind.
+    ttl: int, the number of seconds results are cached for.
+  """
+  with _lock:
+    _ttls[kind] = ttl
+  signals.MODEL_POST_PUT.connect(_OnModelChanged, sender=kind, weak=False)
+  signals.MODEL_POST_DELETE.connect(_OnModelChanged, sender=kind, weak=False)
+
+
+def Disable(kind):
+  """Disables caching of query results for a kind."""
+  with _lock:
+    _ttls.pop(kind, None)
+  signals.MODEL_POST_PUT.disconnect(_OnModelChanged, sender=kind)
+  signals.MODEL_POST_DELETE.disconnect(_OnModelChanged, sender=kind)
+
+
+def IsEnabled(kind):
+  return kind in _ttls
+
+
+def GetGeneration(kind):
+  """Returns the current generation of a kind.
+
+  Args:
+    kind: str, the model kind.
+
+  Returns:
+    int, the generation counter of the kind for this request.
+  """
+  generations = request_state.GetRequestState(_GENERATIONS_VAR)
+  generation = generations.get(kind)
+  if generation is None:
+    key = constants.QUERY_CACHE_MEMCACHE_KEY % kind
+    generation = memcache.get(key)
+    if generation is None:
+      generation = _InitialGeneration()
+      if not memcache.add(key, generation):
+        generation = memcache.get(key) or generation
+    generations[kind] = generation
+  return generation
+
+
+def BumpGeneration(kind):
+  """Invalidates the cached query results of a kind on all instances."""
+  key = constants.QUERY_CACHE_MEMCACHE_KEY % kind
+  generation = memcache.incr(key, initial_value=_InitialGeneration())
+  if generation is None:
+    # Readers will seed a fresh generation from the clock.
+    memcache.delete(key)
+    generation = _InitialGeneration()
+  request_state.GetRequestState(_GENERATIONS_VAR)[kind] = generation
+
+
+def GetKey(kind, operation, **params):
+  """Returns the cache key of a query.
+
+  The key includes the current generation of the kind, so it must be computed
+  before the query is run.
+
+  Args:
+    kind: str, the model kind.
+    operation: str, the name of the query operation.
+    **params: dict, the query parameters. Sets and tuples are normalized.
+
+  Returns:
+    tuple, the cache key, or None if caching is disabled for the kind or the
+    parameters can't be fingerprinted.
+  """
+  if not IsEnabled(kind):
+    return None
+  try:
+    fingerprint = json_utils.Dump([operation, params])
+  except (TypeError, ValueError):
+    return None
+  return kind, GetGeneration(kind), hashlib.sha1(fingerprint).digest()
+
+
+def Get(key):
+  """Returns a copy of the cached result for key, or MISSING.
+
+  Args:
+    key: tuple, the cache key returned by GetKey().
+
+  Returns:
+    The cached value, or MISSING if there is none.
+  """
+  kind = key[0]
+  entry = _entries.Get(key)
+  if entry is not MISSING and entry[0] < time.time():
+    _entries.Pop(key)
+    entry = MISSING
+  with _lock:
+    if entry is MISSING:
+      _misses[kind] += 1
+      return MISSING
+    _hits[kind] += 1
+  return pickle.loads(entry[1])
+
+
+def Set(key, value):
+  """Caches a query result.
+
+  Args:
+    key: tuple, the cache key returned by GetKey().
+    value: *, the picklable result to cache. It is copied.
+  """
+  ttl = _ttls.get(key[0])
+  if ttl is None:
+    return
+  data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+  if len(data) <= constants.QUERY_CACHE_MAX_ENTRY_BYTES:
+    _entries.Set(key, (time.time() + ttl, data))
+
+
+def Clear():
+  """Drops all locally cached results."""
+  _entries.Clear()
+
+
+def GetStats():
+  """Returns cache hit and miss counters since the instance started.
+
+  Returns:
+    dict<str, dict>, kind to a dict with 'hits' and 'misses' counts.
+  """
+  with _lock:
+    return {kind: {'hits': _hits[kind], 'misses': _misses[kind]}
+            for kind in set(_hits) | set(_misses)}
@@ -0,0 +1,84 @@
+"""Tests for query_cache."""
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from _base.utils import constants
+from _base.utils import query_cache
+from _base.utils import signals
+
+
+class CachedModel(signals.SignalMixin, ndb.Model):
+  name = ndb.StringProperty()
+
+
+class QueryCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.kind = CachedModel._get_kind()  # pylint: disable=protected-access
+    query_cache.Enable(self.kind)
+
+  def tearDown(self):
+    query_cache.Disable(self.kind)
+    query_cache.Clear()
+    self.testbed.deactivate()
+
+  def _GetStoredGeneration(self):
+    return memcache.get(constants.QUERY_CACHE_MEMCACHE_KEY % self.kind)
+
+  def testPutBumpsGeneration(self):
+    generation = query_cache.GetGeneration(self.kind)
+    CachedModel(name='a').put()
+    self.assertGreater(self._GetStoredGeneration(), generation)
+
+  def testDeleteBumpsGeneration(self):
+    key = CachedModel(name='a').put()
+    generation = query_cache.GetGeneration(self.kind)
+    key.delete()
+    self.assertGreater(self._GetStoredGeneration(), generation)
+
+  def testTransactionalPutBumpsGenerationOnCommit(self):
+    generation = query_cache.GetGeneration(self.kind)
+
+    @ndb.transactional
+    def _Put():
+      CachedModel(name='a').put()
+      self.assertEqual(generation, self._GetStoredGeneration())
+
+    _Put()
+    self.assertGreater(self._GetStoredGeneration(), generation)
+
+  def testRolledBackPutKeepsGeneration(self):
+    generation = query_cache.GetGeneration(self.kind)
+
+    @ndb.transactional
+    def _Put():
+      CachedModel(name='a').put()
+      raise ndb.Rollback()
+
+    _Put()
+    self.assertEqual(generation, self._GetStoredGeneration())
+
+  def testCachedReadIsMissedAfterTransactionalPut(self):
+    key = query_cache.GetKey(self.kind, 'Read', filters={'name': 'a'})
+    query_cache.Set(key, ([], None, False))
+
+    @ndb.transactional
+    def _Put():
+      CachedModel(name='a').put()
+
+    _Put()
+    key = query_cache.GetKey(self.kind, 'Read', filters={'name': 'a'})
+    self.assertIs(query_cache.MISSING, query_cache.Get(key))
+
+
+if __name__ == '__main__':
+  unittest.main()
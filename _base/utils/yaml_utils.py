@@ -1,15 +1,26 @@
 """Utilities for working with YAML."""
 
 import collections
+import cPickle as pickle
+import os
 import yaml
 
 from _base.utils import bundle
+from _base.utils import constants
+from _base.utils import lru_cache
 
 
 YAMLError = yaml.YAMLError  # pylint: disable=g-bad-name
 
+# Use the libyaml C bindings when they are available.
+_SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-class OrderedDumper(yaml.SafeDumper):
+# Pickled parse results of files by path, modification time and size.
+_PARSE_CACHE = lru_cache.LruCache(64)
+
+
+class OrderedDumper(_SafeDumper):
   """Properly handles dumping OrderedDict instance properties in order."""
 
   def represent_ordered_dict(self, data):  # pylint: disable=g-bad-name
@@ -27,7 +38,7 @@ OrderedDumper.add_representer(
     collections.OrderedDict, OrderedDumper.represent_ordered_dict)
 
 
-class OrderedLoader(yaml.SafeLoader):
+class OrderedLoader(_SafeLoader):
   """Loads mappings into OrderedDict instances to preserve property order."""
 
   def construct_yaml_ordered_dict(self, node):  # pylint: disable=g-bad-name
@@ -64,6 +75,24 @@ def Dump(obj, **kwargs):
   return yaml.dump_all([obj], Dumper=OrderedDumper, **kwargs)
 
 
+def _LoadCached(key, load):
+  """Returns a copy of the cached parse result for key, parsing on a miss.
+
+  Args:
+    key: hashable, the cache key of the document.
+    load: function, parses the document.
+
+  Returns:
+    The corresponding Python object.
+  """
+  result = _PARSE_CACHE.Get(key)
+  if result is lru_cache.MISSING:
+    result = pickle.dumps(load(), pickle.HIGHEST_PROTOCOL)
+    _PARSE_CACHE.Set(key, result)
+  # Unpickle a copy for every caller, the result may be modified.
+  return pickle.loads(result)
+
+
 def Load(data):
   """Parse a YAML string or file and produce a Python object.
 
@@ -75,16 +104,55 @@ def Load(data):
   Returns:
     The corresponding Python object.
   """
+  if hasattr(data, 'read'):
+    data = data.read()
   return yaml.load(data, Loader=OrderedLoader)
 
 
 def LoadFromFile(path):
   """Loads metadata from the YAML file at path.
 
+  Files that aren't in the metadata snapshot are parsed once per modification
+  time and size.
+
   Args:
     path: string, path name of the YAML file.
 
   Returns:
     The corresponding Python object.
   """
-  return Load(bundle.OpenFile(path))
+  data = bundle.LoadFromSnapshot(path)
+  if data is bundle.MISSING:
+    with bundle.OpenFile(path) as f:
+      stat = os.fstat(f.fileno())
+      data = _LoadCached((f.name, stat.st_mtime, stat.st_size),
+                         lambda: Load(f))
+  return data
+
+
+def CompileMetadataSnapshot():
+  """Compiles all metadata YAML files into the metadata snapshot.
+
+  This is a build step, run it before deploying so that instances don't have
+  to parse YAML on cold start:
+
+    python -m _base.utils.yaml_utils
+
+  Returns:
+    list<str>, the paths of the compiled files.
+  """
+  files = sorted(bundle.LocateMetadataYamlFiles())
+  contents = {}
+  for filename in files + [constants.METADATA_FILE_LIST]:
+    try:
+      source = bundle.ReadFile(filename)
+    except IOError:
+      continue
+    contents[filename] = (source, Load(source))
+  bundle.WriteSnapshot(contents)
+  return sorted(contents)
+
+
+if __name__ == '__main__':
+  for compiled_file in CompileMetadataSnapshot():
+    print(compiled_file)
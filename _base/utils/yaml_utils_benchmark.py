@@ -0,0 +1,71 @@
+"""Benchmarks yaml_utils.Load against the pure-Python ordered loader.
+
+Parses generated metadata documents of several sizes with the loader
+yaml_utils used before (a SafeLoader subclass) and with the current loader
+(CSafeLoader when PyYAML has libyaml), and loads them from a file with
+LoadFromFile, which parses a file once per modification time and size.
+
+Usage:
+
+  python -m _base.utils.yaml_utils_benchmark
+"""
+
+import collections
+import os
+import shutil
+import tempfile
+
+import yaml
+
+from _base.utils import benchmark_utils
+from _base.utils import yaml_utils
+
+_FIELD_COUNTS = (10, 100, 1000)
+
+
+class _PurePythonLoader(yaml.SafeLoader):
+  """The ordered loader before it used the libyaml bindings."""
+
+  def construct_yaml_ordered_dict(self, node):  # pylint: disable=g-bad-name
+    data = collections.OrderedDict()
+    yield data
+    data.update(self.construct_pairs(node))
+
+_PurePythonLoader.add_constructor(
+    u'tag:yaml.org,2002:map', _PurePythonLoader.construct_yaml_ordered_dict)
+
+
+def _CreateDocument(field_count):
+  return yaml_utils.Dump({'Benchmark': {'fields': collections.OrderedDict(
+      ('field%04d' % i, collections.OrderedDict([
+          ('property_type', 'STRING'),
+          ('display_order', i),
+          ('choices', ['a', 'b', 'c']),
+          ('description', 'Field number %d.' % i),
+      ])) for i in xrange(field_count))}})
+
+
+def main():
+  directory = tempfile.mkdtemp()
+  try:
+    rows = []
+    for field_count in _FIELD_COUNTS:
+      document = _CreateDocument(field_count)
+      path = os.path.join(directory, 'benchmark%d.yaml' % field_count)
+      with open(path, 'w') as f:
+        f.write(document)
+      pure = benchmark_utils.Time(
+          lambda: yaml.load(document, Loader=_PurePythonLoader))
+      current = benchmark_utils.Time(lambda: yaml_utils.Load(document))
+      from_file = benchmark_utils.Time(lambda: yaml_utils.LoadFromFile(path))
+      rows.append([field_count, len(document), pure, current, from_file])
+    benchmark_utils.PrintTable(
+        'YAML load (us, libyaml %s)' % (
+            'on' if hasattr(yaml, 'CSafeLoader') else 'off'),
+        ['fields', 'bytes', 'pure Python', 'current', 'file, cached'], rows)
+  finally:
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  main()